@@ -0,0 +1,69 @@
+"""
+Benchmark of concurrent reads.
+
+Measures total get throughput of 1, 2, 4 and 8 reader threads using pinned readers, alone and while
+one writer thread keeps applying batches to the trie.
+
+Usage: python -m benchmarks.bench_concurrency
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mpt import MerklePatriciaTrie, NodeCache
+
+
+def _read(trie, keys, deadline):
+    reads = 0
+    while time.perf_counter() < deadline:
+        reader = trie.reader()
+        for key in keys[:1000]:
+            reader.get(key)
+        reads += 1000
+        keys = keys[1000:] + keys[:1000]
+
+    return reads
+
+
+def _write(trie, keys, stop):
+    value = 0
+    while not stop.is_set():
+        value += 1
+        trie.apply_batch((key, value.to_bytes(4, 'big')) for key in keys[:1000])
+
+
+def _measure(trie, keys, threads, with_writer, duration=2.0):
+    stop = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=threads + 1) as executor:
+        writer = executor.submit(_write, trie, keys, stop) if with_writer else None
+
+        deadline = time.perf_counter() + duration
+        readers = [executor.submit(_read, trie, keys[idx::threads], deadline) for idx in range(threads)]
+        reads = sum(reader.result() for reader in readers)
+
+        stop.set()
+        if writer is not None:
+            writer.result()
+
+    print('{} readers{:<14} {:>8.0f} gets/s'.format(threads, ' + writer' if with_writer else '', reads / duration))
+
+
+def main():
+    keys = sorted(os.urandom(32) for _ in range(50000))
+    storage = {}
+    root = MerklePatriciaTrie.from_sorted_items(storage, ((key, key) for key in keys)).root()
+    trie = MerklePatriciaTrie(storage, root, cache=NodeCache(max_entries=200000))
+
+    # Warm up the cache, so all the measurements are in the same conditions.
+    trie.get_many(keys)
+
+    print('CPUs: {}'.format(os.cpu_count()))
+    for with_writer in (False, True):
+        for threads in (1, 2, 4, 8):
+            _measure(trie, keys, threads, with_writer)
+
+
+if __name__ == '__main__':
+    main()
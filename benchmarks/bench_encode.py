@@ -0,0 +1,53 @@
+"""
+Benchmark of node encoding on updates.
+
+Counts how many nodes are encoded per update, and how many of them are written to the storage.
+Every node is encoded exactly once, so the difference is made by the inline nodes, which aren't stored.
+
+Usage: python -m benchmarks.bench_encode
+"""
+import random
+from unittest import mock
+
+from mpt import MerklePatriciaTrie
+from mpt.node import Node
+
+
+class _CountingStorage(dict):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def __setitem__(self, key, value):
+        self.writes += 1
+        super().__setitem__(key, value)
+
+
+def main():
+    random.seed(42)
+    keys = [bytes('{}'.format(random.randint(1, 1000000)), 'utf-8') for _ in range(10000)]
+
+    encode_calls = [0]
+    original_encodes = {cls: cls._encode for cls in (Node.Leaf, Node.Extension, Node.Branch)}
+
+    def counting(cls):
+        def _encode(node):
+            encode_calls[0] += 1
+            return original_encodes[cls](node)
+        return _encode
+
+    storage = _CountingStorage()
+    trie = MerklePatriciaTrie(storage)
+
+    with mock.patch.object(Node.Leaf, '_encode', counting(Node.Leaf)), \
+            mock.patch.object(Node.Extension, '_encode', counting(Node.Extension)), \
+            mock.patch.object(Node.Branch, '_encode', counting(Node.Branch)):
+        for kv in keys:
+            trie.update(kv, kv * 2)
+
+    print('Node encodes per update: {:.2f}'.format(encode_calls[0] / len(keys)))
+    print('Stored nodes per update: {:.2f}'.format(storage.writes / len(keys)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark of the get/update/delete engine.
+
+Measures operations per second for random 32-byte keys and for long unhashed keys
+sharing long prefixes (deep tries).
+
+If a git revision is provided, the same measurements are also made with the `mpt` package from that revision,
+e.g. the commit before the iterative engine to compare it with the recursive one. Keys are generated from
+a fixed seed, so both runs use the same keys.
+
+Usage: python -m benchmarks.bench_engine [revision]
+"""
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from mpt import MerklePatriciaTrie
+
+
+def _measure(name, keys):
+    trie = MerklePatriciaTrie({})
+
+    start = time.perf_counter()
+    for key in keys:
+        trie.update(key, key)
+    update_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for key in keys:
+        trie.get(key)
+    get_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for key in keys:
+        trie.delete(key)
+    delete_time = time.perf_counter() - start
+
+    print('{:<24} update: {:>8.0f} ops/s  get: {:>8.0f} ops/s  delete: {:>8.0f} ops/s'.format(
+        name, len(keys) / update_time, len(keys) / get_time, len(keys) / delete_time))
+
+
+def _measure_revision(revision):
+    """ Runs this benchmark in a subprocess with the `mpt` package extracted from the git revision. """
+    repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        archive = subprocess.run(['git', 'archive', revision, 'mpt'], cwd=repository, stdout=subprocess.PIPE,
+                                 check=True).stdout
+        subprocess.run(['tar', '-x', '-C', directory], input=archive, check=True)
+
+        # Script directory goes first in `sys.path`, so `mpt` is imported from PYTHONPATH, not from the checkout.
+        env = dict(os.environ, PYTHONPATH=directory)
+        subprocess.run([sys.executable, os.path.abspath(__file__)], env=env, check=True)
+
+
+def main():
+    if len(sys.argv) > 1:
+        print('Revision {}:'.format(sys.argv[1]))
+        _measure_revision(sys.argv[1])
+        print('Working tree:')
+
+    rng = random.Random(42)
+
+    keys = [rng.randbytes(32) for _ in range(10000)]
+    _measure('32-byte keys', keys)
+
+    # Keys share long prefixes, so the trie is deep.
+    prefix = rng.randbytes(200)
+    keys = [prefix + rng.randbytes(8) for _ in range(2000)]
+    _measure('long unhashed keys', keys)
+
+    keys = [b'k' * length for length in range(1, 200)]
+    rng.shuffle(keys)
+    _measure('nested keys (depth 400)', keys)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Benchmark of the parallel encoding and hashing on batch commit.
+
+Measures the commit time (encoding, hashing and writing of all the nodes) of a batch importing
+random 32-byte keys, serially and with thread and process pools of 1, 2, 4 and 8 workers.
+
+Usage: python -m benchmarks.bench_parallel
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from mpt import MerklePatriciaTrie
+
+
+def _measure(name, items, executor=None):
+    trie = MerklePatriciaTrie({})
+
+    with trie.batch(executor):
+        for key, value in items:
+            trie.update(key, value)
+
+        # Nodes are encoded and hashed on exit from the batch.
+        start = time.perf_counter()
+    elapsed = time.perf_counter() - start
+
+    print('{:<16} commit: {:>6.2f} s'.format(name, elapsed))
+    return trie.root_hash()
+
+
+def main():
+    items = [(key, key) for key in (os.urandom(32) for _ in range(100000))]
+    print('CPUs: {}'.format(os.cpu_count()))
+
+    expected_root = _measure('serial', items)
+
+    for workers in (1, 2, 4, 8):
+        for name, executor_class in (('threads', ThreadPoolExecutor), ('processes', ProcessPoolExecutor)):
+            with executor_class(max_workers=workers) as executor:
+                root = _measure('{} x{}'.format(name, workers), items, executor)
+
+            assert root == expected_root
+
+
+if __name__ == '__main__':
+    main()
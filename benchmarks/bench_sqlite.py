@@ -0,0 +1,49 @@
+"""
+Benchmark of SqliteStorage against the plain dict storage.
+
+Measures batched import, single lookups and batched lookups of random 32-byte keys.
+
+Usage: python -m benchmarks.bench_sqlite
+"""
+import os
+import tempfile
+import time
+
+from mpt import MerklePatriciaTrie
+from mpt.sqlite_storage import SqliteStorage
+
+
+def _measure(name, storage, keys):
+    trie = MerklePatriciaTrie(storage)
+
+    start = time.perf_counter()
+    for offset in range(0, len(keys), 1000):
+        trie.apply_batch((key, key) for key in keys[offset:offset + 1000])
+    import_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for key in keys:
+        trie.get(key)
+    get_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for offset in range(0, len(keys), 1000):
+        trie.get_many(keys[offset:offset + 1000])
+    get_many_time = time.perf_counter() - start
+
+    print('{:<8} import: {:>8.0f} keys/s  get: {:>8.0f} keys/s  get_many: {:>8.0f} keys/s'.format(
+        name, len(keys) / import_time, len(keys) / get_time, len(keys) / get_many_time))
+
+
+def main():
+    keys = [os.urandom(32) for _ in range(20000)]
+
+    _measure('dict', {}, keys)
+
+    with tempfile.TemporaryDirectory() as directory:
+        with SqliteStorage(os.path.join(directory, 'nodes.db')) as storage:
+            _measure('sqlite', storage, keys)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,5 +13,13 @@ __version__ = '0.1.0'
 
 
 from .mpt import MerklePatriciaTrie
+from .cache import NodeCache
+from .proof import verify_proof
+from .pruning import RefCountPruner
+from .compact import compact
+from .diff import diff
+from .storage import Storage, DictStorage, DbmStorage, WriteBuffer
+from .segment_storage import SegmentStorage
+from .sqlite_storage import SqliteStorage
 
 name = "mpt"
@@ -0,0 +1,93 @@
+"""
+Registry of the hash and codec implementations.
+
+Each kind of backend ('keccak' and 'rlp') has a list of implementations in order of preference, from the fastest
+one. Implementations are imported lazily: the first installed one is selected on the first use, so `import mpt`
+doesn't import any heavy dependencies. Selection may be overridden with `use_backend`.
+"""
+
+# Kind of backend -> list of (name, loader) in order of preference. Loader imports the implementation
+# and returns it, or raises ImportError if it isn't installed.
+_loaders = {}
+# Kind of backend -> (name, implementation) of the selected backend.
+_active = {}
+
+
+def register_backend(kind, name, loader):
+    """
+    Adds an implementation to the end of the list of backends of the given kind.
+
+    Parameters
+    ----------
+    kind: str
+        Kind of the backend, e.g. 'keccak'.
+    name: str
+        Name of the implementation.
+    loader: callable
+        Function that imports the implementation and returns it. It must raise ImportError
+        if the implementation isn't available.
+    """
+    _loaders.setdefault(kind, []).append((name, loader))
+
+
+def use_backend(kind, name):
+    """
+    Selects the implementation of the given kind, importing it right away.
+
+    Parameters
+    ----------
+    kind: str
+        Kind of the backend: 'keccak' or 'rlp'.
+    name: str
+        Name of the implementation, one of `available_backends(kind)`.
+
+    Raises
+    ------
+    ValueError
+        ValueError is raised if there is no such a backend.
+    ImportError
+        ImportError is raised if the implementation isn't installed.
+    """
+    for backend_name, loader in _loaders.get(kind, ()):
+        if backend_name == name:
+            _active[kind] = (name, loader())
+            return
+
+    raise ValueError("Unknown {} backend: {}".format(kind, name))
+
+
+def available_backends(kind):
+    """ Returns names of all the registered implementations of the given kind in order of preference. """
+    return [name for name, _ in _loaders.get(kind, ())]
+
+
+def active_backends():
+    """ Returns a dict mapping every kind of backend to the name of the selected implementation. """
+    return {kind: _select(kind)[0] for kind in _loaders}
+
+
+def get_backend(kind):
+    """ Returns the selected implementation of the given kind, selecting the first installed one if needed. """
+    active = _active.get(kind)
+    if active is None:
+        active = _select(kind)
+
+    return active[1]
+
+
+def _select(kind):
+    """ Returns (name, implementation) of the selected backend. Selects the first installed one if needed. """
+    active = _active.get(kind)
+    if active is not None:
+        return active
+
+    for name, loader in _loaders.get(kind, ()):
+        try:
+            implementation = loader()
+        except ImportError:
+            continue
+
+        _active[kind] = (name, implementation)
+        return _active[kind]
+
+    raise ImportError("None of the {} backends is installed: {}".format(kind, ', '.join(available_backends(kind))))
@@ -0,0 +1,97 @@
+import threading
+from collections import OrderedDict
+
+
+class NodeCache:
+    def __init__(self, max_entries=10000, max_bytes=None):
+        """
+        Creates a new cache of decoded nodes with approximate LRU eviction.
+
+        Cache maps 32-byte node hashes to decoded nodes. When cache is full, nodes are evicted with the CLOCK
+        algorithm: nodes are kept in order of insertion, and a hit only sets the reference bit of the node.
+        The oldest node is evicted unless its bit is set, in which case the bit is cleared and the node gets
+        another round. Cached nodes are shared, so they must never be changed in place.
+        One cache may be shared between several tries working over the same storage.
+
+        Cache is thread-safe, so it may be shared between the tries used by different threads. Lookups don't
+        take any locks: only `put` (and eviction) is serialized. Under concurrent use `hits` and `misses`
+        counters are approximate, and a lookup racing with eviction may miss a node that is being moved.
+
+        Parameters
+        ----------
+        max_entries: int
+            (Optional) Maximum amount of nodes kept in the cache. `None` means no limit.
+        max_bytes: int
+            (Optional) Maximum total size of the encoded cached nodes in bytes. `None` means no limit.
+
+        Returns
+        -------
+        NodeCache
+            An instance of the node cache.
+        """
+        if max_entries is None and max_bytes is None:
+            raise ValueError("Either max_entries or max_bytes must be provided")
+
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        # Hash -> [node, size of the encoded node, reference bit], in order of insertion.
+        self._entries = OrderedDict()
+        self._size = 0
+        # Lookups only set the reference bit of the entry in place, so only the changes of the entries
+        # are serialized.
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, node_hash):
+        return node_hash in self._entries
+
+    def size(self):
+        """ Returns the total size of the encoded cached nodes in bytes. """
+        return self._size
+
+    def get(self, node_hash):
+        """ Returns the cached node or `None` if there is no such a node in the cache. """
+        entry = self._entries.get(node_hash)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        entry[2] = True
+        return entry[0]
+
+    def put(self, node_hash, node, size):
+        """ Stores the decoded node with the size of its encoding in the cache. """
+        if self._max_bytes is not None and size > self._max_bytes:
+            return
+
+        with self._lock:
+            old_entry = self._entries.pop(node_hash, None)
+            if old_entry is not None:
+                self._size -= old_entry[1]
+
+            self._entries[node_hash] = [node, size, False]
+            self._size += size
+
+            while (self._max_entries is not None and len(self._entries) > self._max_entries) or \
+                    (self._max_bytes is not None and self._size > self._max_bytes):
+                oldest_hash, entry = self._entries.popitem(last=False)
+                if entry[2] or (oldest_hash == node_hash and self._entries):
+                    # Node was used since the last round (or was just added), it's given another one.
+                    entry[2] = False
+                    self._entries[oldest_hash] = entry
+                else:
+                    self._size -= entry[1]
+
+    def clear(self):
+        """ Removes all the nodes from the cache and resets hit/miss counters. """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,158 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from itertools import islice
+from .node import Node, _child_hashes
+
+# Maximum amount of nodes returned by a worker at once. The rest of the subtree is walked by the next task.
+_CHUNK_SIZE = 4096
+# Maximum amount of tasks submitted to the executor at once. Together with the chunk size it bounds
+# the amount of nodes collected by the workers but not written yet.
+_PARALLEL_TASKS = 64
+
+
+def compact(storage, live_roots, dest_storage, progress=None, progress_interval=10000, executor=None):
+    """
+    Copies all the nodes reachable from the live roots into the new storage.
+
+    Storage is walked depth-first starting from each root, so memory usage is bounded by the depth of the tries.
+    A node is written only after its whole subtree is in `dest_storage`, so nodes already present there are
+    considered copied together with their subtrees. Shared subtrees are walked only once, and an interrupted
+    compaction may be continued by calling `compact` again with the same destination.
+
+    If `executor` is provided, subtrees under the roots are walked by the executor in parallel. Workers return
+    the nodes of their subtrees in chunks of bounded size, together with the state of the walk to continue it,
+    and all the writes are made by the calling thread. Amount of tasks in flight is bounded as well, so memory
+    usage doesn't depend on the size of the tries. With `concurrent.futures.ProcessPoolExecutor` both storages must be picklable and must
+    give access to the same data in every process (e.g. on-disk storages); `dest_storage` is only read there.
+    Nodes shared between subtrees may be copied (and counted) by several workers, and `progress` is called
+    as the chunks are written, at most once per `progress_interval` nodes.
+
+    Parameters
+    ----------
+    storage: dict-like
+        Storage to copy nodes from.
+    live_roots: iterable of bytes
+        Root nodes (as returned by `MerklePatriciaTrie.root`) of the tries that must be kept.
+    dest_storage: dict-like
+        Storage to copy nodes to. It must implement `__contains__`.
+    progress: callable
+        (Optional) Function called with the amount of copied nodes every `progress_interval` nodes and at the end.
+    progress_interval: int
+        (Optional) How often `progress` is called.
+    executor: concurrent.futures.Executor
+        (Optional) Executor to walk the subtrees in parallel.
+
+    Returns
+    -------
+    int
+        Amount of copied nodes.
+    """
+    # Inline roots don't reference any stored nodes.
+    roots = [root for root in live_roots if root and len(root) == 32]
+
+    if executor is None:
+        copied = _copy_subtrees(storage, dest_storage, roots, progress, progress_interval)
+    else:
+        copied = _copy_subtrees_parallel(storage, dest_storage, roots, progress, progress_interval, executor)
+
+    if progress is not None:
+        progress(copied)
+
+    return copied
+
+
+def _walk_subtrees(storage, dest_storage, pending):
+    """
+    Yields (hash, raw node) of the nodes from the stack of the walk and all the nodes reachable from them
+    that are not in the destination yet. Every node is yielded after all its children.
+
+    Stack consists of (node hash, raw node) pairs, where raw node is `None` if the node isn't read yet.
+    Read node stays on the stack below its children, and is yielded once all of them are processed.
+    Stack is changed in place, so if the walk is stopped, it may be continued with the same stack.
+    """
+    while pending:
+        node_hash, raw_node = pending.pop()
+        if node_hash in dest_storage:
+            # Node is copied already, either before or as a part of another subtree.
+            continue
+
+        if raw_node is None:
+            raw_node = storage[node_hash]
+            pending.append((node_hash, raw_node))
+            pending.extend((child_hash, None) for child_hash in _child_hashes(Node.decode(raw_node)))
+        else:
+            yield node_hash, raw_node
+
+
+def _copy_subtrees(storage, dest_storage, node_hashes, progress=None, progress_interval=10000):
+    """ Copies nodes with provided hashes and all the nodes reachable from them. Returns amount of copied nodes. """
+    copied = 0
+
+    pending = [(node_hash, None) for node_hash in node_hashes]
+
+    for node_hash, raw_node in _walk_subtrees(storage, dest_storage, pending):
+        dest_storage[node_hash] = raw_node
+        copied += 1
+
+        if progress is not None and copied % progress_interval == 0:
+            progress(copied)
+
+    return copied
+
+
+def _collect_chunk(storage, dest_storage, pending):
+    """
+    Continues the walk with the provided stack. Returns a list of at most `_CHUNK_SIZE` (hash, raw node)
+    of the nodes to copy, children before parents, and the stack to continue the walk with.
+    """
+    walk = _walk_subtrees(storage, dest_storage, pending)
+    # Nodes may be shared within the subtree. Dict keeps the first occurrence, which follows its children.
+    items = dict(islice(walk, _CHUNK_SIZE))
+    return list(items.items()), pending
+
+
+def _copy_subtrees_parallel(storage, dest_storage, roots, progress, progress_interval, executor):
+    """ Submits walks of the subtrees under the roots to the executor and writes the collected nodes. """
+    roots = [root for root in dict.fromkeys(roots) if root not in dest_storage]
+    raw_roots = [storage[root] for root in roots]
+
+    # Dict is used as an ordered set of subtrees.
+    subtrees = {}
+    for raw_root in raw_roots:
+        for child_hash in _child_hashes(Node.decode(raw_root)):
+            subtrees[child_hash] = None
+
+    # Stacks of the walks that aren't finished yet.
+    walks = deque([(child_hash, None)] for child_hash in subtrees)
+    running = set()
+
+    copied = 0
+    while walks or running:
+        while walks and len(running) < _PARALLEL_TASKS:
+            running.add(executor.submit(_collect_chunk, storage, dest_storage, walks.popleft()))
+
+        done, running = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            items, pending = future.result()
+            # Nodes are written before the walk is continued, so the next chunk doesn't include them again.
+            _put_many(dest_storage, items)
+            if pending:
+                walks.append(pending)
+
+            reported = copied // progress_interval
+            copied += len(items)
+            if progress is not None and copied // progress_interval > reported:
+                progress(copied)
+
+    # Roots are written last, when all their subtrees are copied.
+    _put_many(dest_storage, zip(roots, raw_roots))
+    return copied + len(roots)
+
+
+def _put_many(storage, items):
+    put_many = getattr(storage, 'put_many', None)
+    if put_many is not None:
+        put_many(items)
+    else:
+        for key, value in items:
+            storage[key] = value
@@ -0,0 +1,163 @@
+from .node import Node
+
+
+def diff(storage, root_a, root_b):
+    """
+    Returns a generator over the keys whose values differ between two tries over the same storage.
+
+    Both tries are walked together, and subtrees with equal references are skipped without being read,
+    so the cost depends on the size of the change rather than on the size of the tries. Entries are
+    produced lazily and ordered by key.
+
+    Note: in secure mode keys are keccak256 hashes of the original keys.
+
+    Parameters
+    ----------
+    storage: dict-like
+        Storage with the nodes of both tries.
+    root_a: bytes
+        Root node (as returned by `MerklePatriciaTrie.root`) of the old trie. `None` means empty trie.
+    root_b: bytes
+        Root node of the new trie. `None` means empty trie.
+
+    Returns
+    -------
+    generator of (bytes, bytes, bytes)
+        Triples of key, old value and new value. Old value is `None` for added keys,
+        new value is `None` for removed keys.
+    """
+    # Stack of (key prefix as a string of hex digits, position in the old trie, position in the new trie).
+    # Position is a list [node reference, amount of already passed nibbles of the node path, decoded node]
+    # or `None` if there is nothing under the prefix. Top of the stack is the next prefix.
+    stack = [('', _start(root_a), _start(root_b))]
+
+    while stack:
+        prefix, a, b = stack.pop()
+
+        if a is not None and b is not None and a[0] == b[0] and a[1] == b[1]:
+            # Same subtree in both tries.
+            continue
+
+        if a is None and b is None:
+            # Both tries are empty.
+            continue
+
+        if a is None or b is None:
+            # Subtree exists only in one of the tries, all its keys are either added or removed.
+            for key, value in _subtree_items(storage, prefix, a or b):
+                yield (bytes.fromhex(key), None, value) if a is None else (bytes.fromhex(key), value, None)
+            continue
+
+        node_a = _load(storage, a)
+        node_b = _load(storage, b)
+
+        if type(node_a) is Node.Leaf and type(node_b) is Node.Leaf:
+            yield from _diff_leaves(prefix, node_a.path[a[1]:], node_a.data, node_b.path[b[1]:], node_b.data)
+            continue
+
+        value_a, children_a = _expand(storage, a)
+        value_b, children_b = _expand(storage, b)
+
+        # Children are pushed in reverse order, so the smallest one is processed first.
+        for idx in range(15, -1, -1):
+            if children_a[idx] is not None or children_b[idx] is not None:
+                stack.append((prefix + '0123456789abcdef'[idx], children_a[idx], children_b[idx]))
+
+        # Value under the prefix has the shortest key, so it goes before the children.
+        if value_a != value_b:
+            yield bytes.fromhex(prefix), value_a, value_b
+
+
+def _start(root):
+    """ Returns the position at the root of the trie. """
+    if not root or root == Node.EMPTY_HASH:
+        return None
+
+    return [root, 0, None]
+
+
+def _load(storage, position):
+    """ Returns the node at the position, decoding it only once. """
+    if position[2] is None:
+        node_ref = position[0]
+        position[2] = Node.decode(storage[node_ref] if len(node_ref) == 32 else node_ref)
+
+    return position[2]
+
+
+def _expand(storage, position):
+    """ Returns the value under the position and the list of positions one nibble deeper. """
+    node = _load(storage, position)
+    passed = position[1]
+    children = [None] * 16
+
+    if type(node) is Node.Branch:
+        for idx, branch in enumerate(node.branches):
+            if branch:
+                children[idx] = [branch, 0, None]
+
+        return node.data or None, children
+
+    if passed == len(node.path):
+        if type(node) is Node.Leaf:
+            return node.data, children
+
+        # End of the extension, the next node is at the same position.
+        return _expand(storage, [node.next_ref, 0, None])
+
+    # Inside of the leaf or extension path there is only one child.
+    children[node.path.at(passed)] = [position[0], passed + 1, node]
+    return None, children
+
+
+def _diff_leaves(prefix, path_a, data_a, path_b, data_b):
+    """ Yields the difference between two leaves under the same prefix, ordered by key. """
+    key_a = prefix + path_a.hex()
+    key_b = prefix + path_b.hex()
+
+    if key_a == key_b:
+        if data_a != data_b:
+            yield bytes.fromhex(key_a), data_a, data_b
+    elif key_a < key_b:
+        yield bytes.fromhex(key_a), data_a, None
+        yield bytes.fromhex(key_b), None, data_b
+    else:
+        yield bytes.fromhex(key_b), None, data_b
+        yield bytes.fromhex(key_a), data_a, None
+
+
+def _subtree_items(storage, prefix, position):
+    """ Yields all the key-value pairs under the position, ordered by key. Keys are strings of hex digits. """
+    node = _load(storage, position)
+    passed = position[1]
+
+    # Stack of (node, key prefix). Top of the stack is the next node.
+    if type(node) is Node.Branch:
+        stack = [(node, prefix)]
+    else:
+        stack = [(node, prefix + node.path[passed:].hex())]
+
+    while stack:
+        node, prefix = stack.pop()
+
+        if type(node) is Node.Leaf:
+            yield prefix, node.data
+
+        elif type(node) is Node.Extension:
+            next_node = _load(storage, [node.next_ref, 0, None])
+            if type(next_node) is Node.Branch:
+                stack.append((next_node, prefix))
+            else:
+                stack.append((next_node, prefix + next_node.path.hex()))
+
+        elif type(node) is Node.Branch:
+            for idx in range(15, -1, -1):
+                if node.branches[idx]:
+                    child = _load(storage, [node.branches[idx], 0, None])
+                    child_prefix = prefix + '0123456789abcdef'[idx]
+                    if type(child) is not Node.Branch:
+                        child_prefix += child.path.hex()
+                    stack.append((child, child_prefix))
+
+            if node.data:
+                yield prefix, node.data
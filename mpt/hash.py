@@ -1,7 +1,90 @@
-from Crypto.Hash import keccak
+from .backends import get_backend, register_backend
 
 
 def keccak_hash(data):
-    keccak_hash = keccak.new(digest_bits=256)
-    keccak_hash.update(data)
-    return keccak_hash.digest()
+    return get_backend('keccak').hash(data)
+
+
+def keccak_hash_many(items):
+    """
+    Returns a list of keccak256 hashes of all the provided items (e.g. keys or encoded nodes).
+
+    Hashing many items at once is cheaper than calling `keccak_hash` for every item: backends may avoid
+    per-item overhead, e.g. pycryptodome backend resets and reuses a single hashing state.
+    """
+    return get_backend('keccak').hash_many(items)
+
+
+class _KeccakBackend:
+    __slots__ = ('hash', 'hash_many')
+
+    def __init__(self, hash, hash_many=None):
+        self.hash = hash
+        self.hash_many = hash_many if hash_many is not None else lambda items: [hash(item) for item in items]
+
+
+def _load_pysha3():
+    import sha3
+
+    keccak_256 = sha3.keccak_256
+    return _KeccakBackend(lambda data: keccak_256(data).digest())
+
+
+def _load_pycryptodome():
+    from Crypto.Hash import keccak
+
+    new = keccak.new
+
+    def hash(data):
+        return new(data=data, digest_bits=256).digest()
+
+    try:
+        from Crypto.Hash.keccak import _raw_keccak_lib
+        from Crypto.Util._raw_api import (VoidPointer, c_size_t, c_ubyte, c_uint8_ptr, create_string_buffer,
+                                          get_raw_buffer)
+        _raw_keccak_lib.keccak_reset
+    except (ImportError, AttributeError):
+        # Low-level interface is private, so the public one is used if it changes.
+        return _KeccakBackend(hash)
+
+    def hash_many(items):
+        # Keccak256 has capacity of 512 bits, 24 rounds and padding byte 0x01.
+        state = VoidPointer()
+        result = _raw_keccak_lib.keccak_init(state.address_of(), c_size_t(64), c_ubyte(24))
+        if result:
+            raise ValueError("Error {} while instantiating keccak".format(result))
+
+        state_ptr = state.get()
+        buffer = create_string_buffer(32)
+        digest_size = c_size_t(32)
+        padding = c_ubyte(0x01)
+
+        reset = _raw_keccak_lib.keccak_reset
+        absorb = _raw_keccak_lib.keccak_absorb
+        digest = _raw_keccak_lib.keccak_digest
+
+        hashes = []
+        try:
+            for item in items:
+                reset(state_ptr)
+                absorb(state_ptr, c_uint8_ptr(item), c_size_t(len(item)))
+                digest(state_ptr, buffer, digest_size, padding)
+                hashes.append(get_raw_buffer(buffer))
+        finally:
+            _raw_keccak_lib.keccak_destroy(state_ptr)
+
+        return hashes
+
+    return _KeccakBackend(hash, hash_many)
+
+
+def _load_eth_hash():
+    from eth_hash.auto import keccak
+
+    # eth-hash only accepts bytes and bytearray.
+    return _KeccakBackend(lambda data: keccak(bytes(data) if isinstance(data, memoryview) else data))
+
+
+register_backend('keccak', 'pysha3', _load_pysha3)
+register_backend('keccak', 'pycryptodome', _load_pycryptodome)
+register_backend('keccak', 'eth-hash', _load_eth_hash)
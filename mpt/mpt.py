@@ -1,16 +1,23 @@
+import os
+from contextlib import contextmanager
 from enum import Enum
-from .hash import keccak_hash
+from itertools import islice
+from .hash import keccak_hash, keccak_hash_many
 from .nibble_path import NibblePath
-from .node import Node
+from .node import Node, _child_hashes
+from .storage import WriteBuffer
 
 
 class MerklePatriciaTrie:
-    def __init__(self, storage, root=None, secure=False):
+    def __init__(self, storage, root=None, secure=False, cache=None, pruner=None):
         """
         Creates a new instance of MPT.
 
         MerklePatriciaTrie works like a wrapper over provided storage. Storage must implement dict-like interface.
         Any data structure that implements `__getitem__` and `__setitem__` should be OK.
+        If storage also implements bulk methods `get_many` and `put_many` (see `mpt.storage.Storage`),
+        they are used to read and write many nodes at once. If storage is a `mpt.storage.WriteBuffer`,
+        it's flushed on every commit, so the nodes of each commit reach the backend in one bulk write.
 
         Parameters
         ----------
@@ -20,6 +27,25 @@ class MerklePatriciaTrie:
             (Optional) Root node (not root hash!) of the trie. If not provided, tree will be considered empty.
         secure: bool
             (Optional) In secure mode all the keys are hashed using keccak256 internally.
+        cache: NodeCache
+            (Optional) Cache of decoded nodes. It may be shared between tries working over the same storage.
+        pruner: RefCountPruner
+            (Optional) Pruner that removes nodes of the old roots from the storage.
+
+        Concurrency
+        -----------
+        One thread may change the trie while any amount of threads read it. Nodes are immutable and are written
+        to the storage before the root that references them is published, so a reader that pinned a root
+        never sees a partially applied change and doesn't need any locks of the trie. Readers get such pinned
+        tries with `reader`. Roots are published on every commit: after each update or delete, and on exit from
+        the outermost batch or commit of the outermost checkpoint. Changes inside batches and checkpoints
+        aren't visible to readers.
+
+        Storage must allow reads concurrent with writes (dict, SqliteStorage and SegmentStorage do; dbm
+        databases generally don't), and the cache, if any, must be thread-safe. NodeCache is, and its lookups
+        don't take any locks, so reads stay lock-free with a shared cache: only adding nodes to it is serialized.
+        With a pruner, readers must not outlive `keep_roots` commits, otherwise nodes of their roots may be
+        removed while they read.
 
         Returns
         -------
@@ -29,7 +55,110 @@ class MerklePatriciaTrie:
 
         self._storage = storage
         self._root = root
+        # Last committed root together with the storage it's stored in. It's replaced as a whole,
+        # so readers in other threads always see a consistent pair.
+        self._published = (storage, root)
         self._secure = secure
+        self._cache = cache
+        self._pruner = pruner
+        self._batching = False
+        # If it's a list, written nodes are collected there to be stored together.
+        self._write_queue = None
+        # For forks: the trie the fork was made from and the root of the parent at the moment of the fork
+        # (or of the last merge).
+        self._parent = None
+        self._base_root = None
+        # Stack of open checkpoints: (checkpoint id, root at the checkpoint, layer with the nodes written after it).
+        self._checkpoints = []
+        self._next_checkpoint = 0
+
+    def from_sorted_items(storage, items, secure=False):
+        """
+        Builds a new trie from a stream of key-value pairs sorted by key.
+
+        Trie is built bottom-up: each node is encoded, hashed and written to the storage exactly once,
+        as soon as no more keys can get into its subtree. Items are consumed lazily and only the nodes
+        on the path of the last key are kept in memory, so memory usage is bounded by the depth of the trie
+        rather than by the amount of items. Resulting root hash is the same as after inserting all the items
+        with `update`.
+
+        Parameters
+        ----------
+        storage: dict-like
+            Data structure to store all the data of MPT.
+        items: iterable of (bytes, bytes)
+            Pairs of RLP-encoded key and value. Keys must be unique and sorted in ascending order.
+            In secure mode keys must be sorted by their keccak256 hashes.
+        secure: bool
+            (Optional) In secure mode all the keys are hashed using keccak256 internally.
+
+        Returns
+        -------
+        MerklePatriciaTrie
+            An instance of MPT containing all the provided items.
+
+        Raises
+        ------
+        ValueError
+            ValueError is raised if keys are not sorted or not unique.
+        """
+        trie = MerklePatriciaTrie(storage, secure=secure)
+        trie._write_queue = []
+
+        # Stack of branch nodes that still can get new children. Depths of the branches are strictly increasing.
+        stack = []
+        prev_key = None
+        prev_value = None
+
+        if secure:
+            items = _hashed_keys(items)
+
+        for encoded_key, encoded_value in items:
+            # Hex representation of key is a string of nibbles.
+            key = encoded_key.hex()
+
+            if prev_key is not None:
+                if key <= prev_key:
+                    raise ValueError("Keys must be unique and sorted in ascending order")
+
+                # Previous key and all the keys after it can only share the common prefix with each other,
+                # thus all the branches deeper than it can be built.
+                common_len = len(os.path.commonprefix((prev_key, key)))
+                trie._add_sorted_item(stack, prev_key, prev_value, common_len)
+
+                if len(trie._write_queue) >= MerklePatriciaTrie._WRITE_CHUNK:
+                    trie._flush_writes()
+
+            prev_key, prev_value = key, encoded_value
+
+        root = trie._build_sorted_root(stack, prev_key, prev_value)
+        trie._flush_writes()
+        trie._set_root(root)
+        trie._write_queue = None
+
+        return trie
+
+    def _build_sorted_root(self, stack, last_key, last_value):
+        """ Finishes building of the trie by `from_sorted_items`. Returns the root of the trie. """
+        if last_key is None:
+            return None
+
+        if not stack:
+            # Only one key, the trie is a single leaf.
+            return self._store_node(Node.Leaf(_path_from_nibbles(last_key), last_value))
+
+        self._attach_sorted_leaf(stack[-1], last_key, last_value)
+
+        while len(stack) > 1:
+            frame = stack.pop()
+            self._attach_sorted_branch(stack[-1], frame)
+
+        frame = stack.pop()
+        reference = self._store_node(Node.Branch(frame.branches, frame.data))
+        if frame.depth > 0:
+            reference = self._store_node(Node.Extension(_path_from_nibbles(frame.prefix), reference))
+
+        return reference
 
     def root(self):
         """ Returns a root node of the trie. Type is `bytes` if trie isn't empty and `None` othrewise. """
@@ -45,6 +174,22 @@ class MerklePatriciaTrie:
         else:
             return keccak_hash(self._root)
 
+    def reader(self):
+        """
+        Returns a read-only trie pinned to the last committed root, to be used by another thread.
+
+        Reader isn't affected by the subsequent changes of this trie, and may be used concurrently with them.
+        It shares the storage and the cache with this trie. Readers are cheap, so a new one should be taken
+        whenever a newer state is needed. See the concurrency model in `MerklePatriciaTrie.__init__`.
+
+        Returns
+        -------
+        MerklePatriciaTrie
+            Trie pinned to the last committed root. It must not be changed.
+        """
+        storage, root = self._published
+        return MerklePatriciaTrie(storage, root, self._secure, self._cache)
+
     def get(self, encoded_key):
         """
         This method gets a value associtated with provided key.
@@ -78,6 +223,215 @@ class MerklePatriciaTrie:
 
         return result_node.data
 
+    def get_many(self, encoded_keys, bulk=True):
+        """
+        This method gets values associated with several keys at once.
+
+        Trie is traversed level by level for all the keys together, so every node shared by several keys
+        is read and decoded only once. If `bulk` is set and the storage has `get_many` method, all the nodes
+        of one level are read from the storage with a single `get_many` call.
+
+        Note: this method does not RLP-encode the keys. If you use encoded keys, you should encode it yourself.
+
+        Parameters
+        ----------
+        encoded_keys: iterable of bytes
+            RLP-encoded keys.
+        bulk: bool
+            (Optional) Use bulk reads from the storage if it supports them.
+
+        Returns
+        -------
+        list
+            Stored values in the same order as keys. If there is no value for some key, `None` is returned for it.
+        """
+        encoded_keys = list(encoded_keys)
+        results = [None] * len(encoded_keys)
+
+        if not self._root:
+            return results
+
+        if self._secure:
+            encoded_keys = keccak_hash_many(encoded_keys)
+
+        # Current level of the traversal: node reference -> list of (index of the key, rest of the path).
+        level = {self._root: [(idx, NibblePath(encoded_key)) for idx, encoded_key in enumerate(encoded_keys)]}
+
+        while level:
+            nodes = self._get_nodes(level.keys(), bulk)
+            next_level = {}
+
+            for node_ref, lookups in level.items():
+                node = nodes[node_ref]
+
+                for idx, path in lookups:
+                    if type(node) is Node.Leaf:
+                        if node.path == path:
+                            results[idx] = node.data
+
+                    elif type(node) is Node.Extension:
+                        if path.starts_with(node.path):
+                            next_level.setdefault(node.next_ref, []).append((idx, path[len(node.path):]))
+
+                    elif type(node) is Node.Branch:
+                        if len(path) == 0:
+                            results[idx] = node.data or None
+                            continue
+
+                        branch = node.branch(path.at(0))
+                        if branch:
+                            next_level.setdefault(branch, []).append((idx, path[1:]))
+
+            level = next_level
+
+        return results
+
+    def get_proof(self, encoded_key):
+        """
+        This method builds the Merkle proof for the provided key.
+
+        Proof consists of RLP-encoded root node and all the hashed nodes on the path of the key. Proof may show
+        both the value associated with the key and the absence of the key. It can be checked with `verify_proof`.
+
+        Note: this method does not RLP-encode the key. If you use encoded keys, you should encode it yourself.
+
+        Parameters
+        ----------
+        encoded_key: bytes
+            RLP-encoded key.
+
+        Returns
+        -------
+        list of bytes
+            RLP-encoded nodes of the proof, starting from the root.
+        """
+        return self.get_proof_many([encoded_key])
+
+    def get_proof_many(self, encoded_keys):
+        """
+        This method builds one Merkle proof for several keys at once.
+
+        Nodes shared by several keys are included into the proof only once. Each of the keys may be checked
+        with `verify_proof` against the whole returned proof.
+
+        Parameters
+        ----------
+        encoded_keys: iterable of bytes
+            RLP-encoded keys.
+
+        Returns
+        -------
+        list of bytes
+            RLP-encoded nodes of the proof, starting from the root.
+        """
+        if not self._root:
+            return []
+
+        if self._secure:
+            encoded_keys = keccak_hash_many(encoded_keys)
+
+        # Dict is used as an ordered set of nodes.
+        proof = {}
+
+        for encoded_key in encoded_keys:
+            for raw_node in self._proof_path(NibblePath(encoded_key)):
+                proof[raw_node] = None
+
+        return list(proof)
+
+    def _proof_path(self, path):
+        """ Yields RLP-encoded root and all the hashed nodes on the path of the key. """
+        node_ref = self._root
+        is_root = True
+
+        while True:
+            node = self._get_node(node_ref)
+
+            # Inline nodes are the part of their parents, so only the root and hashed nodes are included.
+            if is_root or len(node_ref) == 32:
+                yield node.encode()
+            is_root = False
+
+            if type(node) is Node.Extension and path.starts_with(node.path):
+                node_ref = node.next_ref
+                path = path[len(node.path):]
+            elif type(node) is Node.Branch and len(path) != 0 and node.branch(path.at(0)):
+                node_ref = node.branch(path.at(0))
+                path = path[1:]
+            else:
+                # Either the key is found or it's proven to be absent.
+                return
+
+    def items(self, start=None, end=None):
+        """
+        Returns a generator over key-value pairs stored in the trie, ordered by key.
+
+        Trie is traversed lazily, so only the nodes on the current path are kept in memory.
+        Generator works with the root that was actual at the moment of the call, and isn't affected
+        by the subsequent changes of the trie. Iteration may be resumed by passing the last received key
+        (plus zero byte) as `start`.
+
+        Note: in secure mode keys are keccak256 hashes of the original keys, both for the yielded keys
+        and for `start` and `end`.
+
+        Parameters
+        ----------
+        start: bytes
+            (Optional) Yield only keys greater than or equal to `start`.
+        end: bytes
+            (Optional) Yield only keys less than `end`.
+
+        Returns
+        -------
+        generator of (bytes, bytes)
+            Pairs of key and value.
+        """
+        start = start.hex() if start is not None else None
+        end = end.hex() if end is not None else None
+
+        # Root and storage are taken right away, not on the first step of the generator.
+        pinned = MerklePatriciaTrie(self._storage, self._root, self._secure, self._cache)
+        return pinned._items(start, end)
+
+    def _items(self, start, end):
+        """ Yields key-value pairs between `start` and `end` (strings of hex digits or `None`), ordered by key. """
+        if not self._root:
+            return
+
+        # Stack of (node reference, key prefix as a string of hex digits). Top of the stack is the next node.
+        stack = [(self._root, '')]
+
+        while stack:
+            node_ref, prefix = stack.pop()
+
+            if end is not None and prefix >= end:
+                # All the keys in this subtree and after it are too big.
+                return
+
+            if start is not None and prefix < start and not start.startswith(prefix):
+                # All the keys in this subtree are too small.
+                continue
+
+            node = self._get_node(node_ref)
+
+            if type(node) is Node.Leaf:
+                key = prefix + node.path.hex()
+                if (start is None or key >= start) and (end is None or key < end):
+                    yield bytes.fromhex(key), node.data
+
+            elif type(node) is Node.Extension:
+                stack.append((node.next_ref, prefix + node.path.hex()))
+
+            elif type(node) is Node.Branch:
+                # Children are pushed in reverse order, so the smallest one is processed first.
+                for idx in range(15, -1, -1):
+                    if node.branches[idx]:
+                        stack.append((node.branches[idx], prefix + '0123456789abcdef'[idx]))
+
+                # Value of the branch has the shortest key, so it goes before the children.
+                if node.data and (start is None or prefix >= start):
+                    yield bytes.fromhex(prefix), node.data
+
     def update(self, encoded_key, encoded_value):
         """
         This method updates a provided key-value pair into the trie.
@@ -97,11 +451,15 @@ class MerklePatriciaTrie:
         if self._secure:
             encoded_key = keccak_hash(encoded_key)
 
-        path = NibblePath(encoded_key)
+        self._update_key(encoded_key, encoded_value)
+
+    def _update_key(self, key, encoded_value):
+        """ Updates the value of the key. In secure mode key must be already hashed. """
+        path = NibblePath(key)
 
         result = self._update(self._root, path, encoded_value)
 
-        self._root = result
+        self._set_root(result)
 
     def delete(self, encoded_key):
         """
@@ -120,150 +478,556 @@ class MerklePatriciaTrie:
             KeyError is raised if there is no value assotiated with provided key.
         """
 
-        if self._root is None:
-            return
-
         if self._secure:
             encoded_key = keccak_hash(encoded_key)
 
-        path = NibblePath(encoded_key)
+        self._delete_key(encoded_key)
+
+    def _delete_key(self, key):
+        """ Removes the value of the key. In secure mode key must be already hashed. """
+        if self._root is None:
+            return
+
+        path = NibblePath(key)
 
         action, info = self._delete(self._root, path)
 
         if action == MerklePatriciaTrie._DeleteAction.DELETED:
             # Trie is empty
-            self._root = None
+            self._set_root(None)
         elif action == MerklePatriciaTrie._DeleteAction.UPDATED:
             new_root = info
-            self._root = new_root
+            self._set_root(new_root)
         elif action == MerklePatriciaTrie._DeleteAction.USELESS_BRANCH:
             _, new_root = info
-            self._root = new_root
+            self._set_root(new_root)
+
+    @contextmanager
+    def batch(self, executor=None):
+        """
+        Returns a context manager that groups several updates and deletes into one commit.
+
+        Inside of the batch modified nodes are kept in memory and are neither encoded nor hashed.
+        Every changed node is encoded, hashed and written to the storage only once, when the batch is committed
+        on exit from the context. Resulting root hash is the same as if all the operations were applied one by one.
+
+        If an exception is raised inside of the batch, all the changes are discarded and nothing is written.
+        If writing the nodes on commit fails, the changes are discarded as well, and the trie keeps its old root.
+        Note: `root` and `root_hash` are only meaningful after the batch is committed.
+
+        If `executor` is provided, changed subtrees under the top branches are encoded and hashed by the executor
+        in parallel, and only the top nodes are encoded by the calling thread. Both `ThreadPoolExecutor` and
+        `ProcessPoolExecutor` may be used: encoding doesn't touch the storage, and results are written
+        by the calling thread. Result doesn't depend on the executor.
+        Executor is ignored for nested batches, the outer batch decides how to commit.
+
+        Parameters
+        ----------
+        executor: concurrent.futures.Executor
+            (Optional) Executor to encode and hash the changed nodes in parallel on commit.
+
+        Example
+        -------
+        with trie.batch():
+            trie.update(b'do', b'verb')
+            trie.delete(b'dog')
+        """
+        if self._batching:
+            # Nested batch is just a part of the outer one.
+            yield
+            return
+
+        old_root = self._root
+        self._batching = True
+        try:
+            yield
+        except BaseException:
+            self._root = old_root
+            raise
+        finally:
+            self._batching = False
+
+        self._write_queue = []
+        try:
+            root = self._commit_node(self._root, executor)
+            self._flush_writes()
+        except BaseException:
+            # Root must not stay an uncommitted node if the nodes couldn't be written.
+            self._root = old_root
+            raise
+        finally:
+            self._write_queue = None
+
+        self._set_root(root)
+
+    def apply_batch(self, items, executor=None):
+        """
+        Applies a sequence of changes to the trie as a single batch. See `batch` for details.
+
+        Parameters
+        ----------
+        items: iterable of (bytes, bytes)
+            Pairs of RLP-encoded key and value. If value is `None`, key is deleted from the trie.
+        executor: concurrent.futures.Executor
+            (Optional) Executor to encode and hash the changed nodes in parallel on commit.
+        """
+        if self._secure:
+            items = _hashed_keys(items)
+
+        with self.batch(executor):
+            for key, encoded_value in items:
+                if encoded_value is None:
+                    self._delete_key(key)
+                else:
+                    self._update_key(key, encoded_value)
+
+    def fork(self):
+        """
+        Returns a copy-on-write fork of the trie.
+
+        Fork starts with the current root of the trie and shares all the nodes with it, but the nodes written
+        by the fork are kept in a private in-memory layer over the storage of the trie. Changes of the fork
+        are neither visible to the trie nor written to the storage until the fork is merged with `merge`,
+        and may be thrown away with `discard`. Forking is O(1), and forks may be forked as well.
+
+        Fork shares the cache with the trie, but doesn't use its pruner: nodes written by the fork are
+        registered in the pruner of the trie on merge.
+
+        Returns
+        -------
+        MerklePatriciaTrie
+            Fork of the trie.
+
+        Raises
+        ------
+        ValueError
+            ValueError is raised if called inside of the batch.
+        """
+        if self._batching:
+            raise ValueError("Trie can't be forked inside of the batch")
+
+        fork = MerklePatriciaTrie(WriteBuffer(self._storage), self._root, self._secure, self._cache)
+        fork._parent = self
+        fork._base_root = self._root
+        return fork
+
+    def snapshot(self):
+        """
+        Returns a fork of the trie to work with its current state. See `fork` for details.
+
+        Snapshot is isolated from the subsequent changes of the trie, and changes made through the snapshot
+        don't affect the trie unless the snapshot is merged.
+        """
+        return self.fork()
+
+    def merge(self):
+        """
+        Applies changes of the fork to the trie it was made from.
+
+        New nodes reachable from the root of the fork are written to the storage of the parent trie
+        (for nested forks that's the private layer of the parent), and the root of the parent is set to the root
+        of the fork. Nodes that were written by the fork but aren't used anymore are thrown away.
+        Fork may be used and merged again after that.
+
+        Raises
+        ------
+        ValueError
+            ValueError is raised if the trie isn't a fork, if the root of the parent trie was changed
+            after the fork was made (or last merged) or if the fork has open checkpoints.
+        """
+        parent = self._parent
+        if parent is None:
+            raise ValueError("Only forks can be merged")
+        if parent._root != self._base_root:
+            raise ValueError("Parent trie was changed after the fork")
+        if parent._batching:
+            raise ValueError("Fork can't be merged into the trie inside of the batch")
+        if self._checkpoints:
+            raise ValueError("Fork with open checkpoints can't be merged")
+
+        parent._adopt_nodes(dict(self._storage.changes()), self._root)
+
+        self._storage.discard()
+        self._base_root = self._root
+        parent._set_root(self._root)
+
+    def discard(self):
+        """
+        Throws away all the changes of the fork made after it was made (or last merged). It's O(1).
+
+        Raises
+        ------
+        ValueError
+            ValueError is raised if the trie isn't a fork or if it has open checkpoints.
+        """
+        if self._parent is None:
+            raise ValueError("Only forks can be discarded")
+        if self._checkpoints:
+            raise ValueError("Fork with open checkpoints can't be discarded")
+
+        self._storage.discard()
+        self._set_root(self._base_root)
+
+    def checkpoint(self):
+        """
+        Opens a checkpoint the trie may be reverted to.
+
+        Nodes written after the checkpoint are kept in an in-memory layer over the storage until the checkpoint
+        is committed, so nothing written after a reverted checkpoint ever reaches the storage. Checkpoints may
+        be nested. Both reverting and committing take time proportional to the amount of changes made
+        after the checkpoint.
+
+        While any checkpoint is open, new roots aren't reported to the pruner. The root is reported when
+        the outermost checkpoint is committed.
+
+        Returns
+        -------
+        int
+            Identifier of the checkpoint.
+
+        Raises
+        ------
+        ValueError
+            ValueError is raised if called inside of the batch.
+        """
+        if self._batching:
+            raise ValueError("Checkpoint can't be opened inside of the batch")
+
+        checkpoint_id = self._next_checkpoint
+        self._next_checkpoint += 1
+
+        layer = WriteBuffer(self._storage)
+        self._checkpoints.append((checkpoint_id, self._root, layer))
+        self._storage = layer
+
+        return checkpoint_id
+
+    def revert(self, checkpoint_id):
+        """
+        Reverts the trie to the state at the checkpoint. Checkpoint and all the checkpoints opened after it
+        are closed, and nodes written after the checkpoint are thrown away.
+
+        Parameters
+        ----------
+        checkpoint_id: int
+            Identifier of the open checkpoint returned by `checkpoint`.
+
+        Raises
+        ------
+        ValueError
+            ValueError is raised if there is no such an open checkpoint or if called inside of the batch.
+        """
+        idx = self._checkpoint_index(checkpoint_id)
+
+        _, root, layer = self._checkpoints[idx]
+        del self._checkpoints[idx:]
+
+        self._storage = layer.backend()
+        self._root = root
+
+    def commit(self, checkpoint_id):
+        """
+        Keeps the changes made after the checkpoint. Checkpoint and all the checkpoints opened after it
+        are closed, and their changes become a part of the enclosing checkpoint. If there is no enclosing
+        checkpoint, new nodes reachable from the current root are written to the storage.
+
+        Parameters
+        ----------
+        checkpoint_id: int
+            Identifier of the open checkpoint returned by `checkpoint`.
+
+        Raises
+        ------
+        ValueError
+            ValueError is raised if there is no such an open checkpoint or if called inside of the batch.
+        """
+        idx = self._checkpoint_index(checkpoint_id)
+
+        layers = [layer for _, _, layer in self._checkpoints[idx:]]
+        del self._checkpoints[idx:]
+
+        self._storage = layers[0].backend()
+
+        if self._checkpoints:
+            # Changes go to the layer of the enclosing checkpoint, from the oldest to the newest.
+            for layer in layers:
+                self._storage.put_many(layer.changes())
+            return
+
+        written_nodes = {}
+        for layer in layers:
+            written_nodes.update(layer.changes())
+
+        self._adopt_nodes(written_nodes, self._root)
+        self._set_root(self._root)
+
+    def _checkpoint_index(self, checkpoint_id):
+        """ Returns position of the open checkpoint on the stack. """
+        if self._batching:
+            raise ValueError("Checkpoint can't be closed inside of the batch")
+
+        for idx, (open_id, _, _) in enumerate(self._checkpoints):
+            if open_id == checkpoint_id:
+                return idx
+
+        raise ValueError("There is no open checkpoint {}".format(checkpoint_id))
+
+    def _adopt_nodes(self, written_nodes, root):
+        """
+        Writes to the storage the nodes from `written_nodes` (dict hash -> encoded node) that are reachable
+        from the root. Nodes that aren't in `written_nodes` are considered already stored.
+        """
+        new_nodes = {}
+
+        # Only the new nodes are walked: nodes that aren't in `written_nodes` are already in the storage.
+        pending = [root]
+        while pending:
+            node_hash = pending.pop()
+            raw_node = written_nodes.get(node_hash) if node_hash else None
+            if raw_node is None or node_hash in new_nodes:
+                continue
+
+            node = Node.decode(raw_node)
+            new_nodes[node_hash] = (raw_node, node)
+            pending.extend(_child_hashes(node))
+
+        # Every node is walked before its children, so in reverse order children are registered first.
+        if self._pruner is not None and not self._checkpoints:
+            for node_hash, (_, node) in reversed(new_nodes.items()):
+                self._pruner.node_written(node_hash, node)
+
+        self._write_queue = [(node_hash, raw_node) for node_hash, (raw_node, _) in new_nodes.items()]
+        try:
+            self._flush_writes()
+        finally:
+            self._write_queue = None
+
+    def _set_root(self, root):
+        """
+        Sets the new root of the trie. Outside of the batch and checkpoints it's a commit: the root is reported
+        to the pruner and published for the readers.
+        """
+        self._root = root
+
+        if self._batching or self._checkpoints:
+            return
+
+        if self._parent is None and isinstance(self._storage, WriteBuffer):
+            # Forks keep their changes in the buffer until they are merged.
+            self._storage.flush()
+
+        # All the nodes of the root are already written, so readers may use it right away.
+        self._published = (self._storage, root)
+
+        if self._pruner is not None:
+            self._pruner.commit(root)
 
     def _get_node(self, node_ref):
-        raw_node = None
-        if len(node_ref) == 32:
+        if not isinstance(node_ref, bytes):
+            # Dirty node that isn't committed yet.
+            return node_ref
+
+        if len(node_ref) != 32:
+            return Node.decode(node_ref)
+
+        if self._cache is None:
+            return Node.decode(self._storage[node_ref])
+
+        node = self._cache.get(node_ref)
+        if node is None:
             raw_node = self._storage[node_ref]
+            node = Node.decode(raw_node)
+            self._cache.put(node_ref, node, len(raw_node))
+
+        return node
+
+    def _get_nodes(self, node_refs, bulk=True):
+        """
+        Returns a dict mapping provided references to decoded nodes.
+
+        If `bulk` is set and the storage has `get_many` method, all the nodes that aren't cached are read
+        from the storage at once.
+        """
+        nodes = {}
+        missing_refs = []
+
+        for node_ref in node_refs:
+            if not isinstance(node_ref, bytes) or len(node_ref) != 32:
+                nodes[node_ref] = self._get_node(node_ref)
+                continue
+
+            node = self._cache.get(node_ref) if self._cache is not None else None
+            if node is None:
+                missing_refs.append(node_ref)
+            else:
+                nodes[node_ref] = node
+
+        if not missing_refs:
+            return nodes
+
+        get_many = getattr(self._storage, 'get_many', None) if bulk else None
+        if get_many is not None:
+            raw_nodes = get_many(missing_refs)
         else:
-            raw_node = node_ref
-        return Node.decode(raw_node)
+            raw_nodes = [self._storage[node_ref] for node_ref in missing_refs]
 
-    def _get(self, node_ref, path):
-        """ Get support method """
-        node = self._get_node(node_ref)
+        for node_ref, raw_node in zip(missing_refs, raw_nodes):
+            if raw_node is None:
+                raise KeyError(node_ref)
 
-        # If path is empty, our travel is over. Main `get` method will check if this node has a value.
-        if len(path) == 0:
-            return node
+            node = Node.decode(raw_node)
+            if self._cache is not None:
+                self._cache.put(node_ref, node, len(raw_node))
+            nodes[node_ref] = node
 
-        if type(node) is Node.Leaf:
-            # If we've found a leaf, it's either the leaf we're looking for or wrong leaf.
-            if node.path == path:
-                return node
+        return nodes
 
-        elif type(node) is Node.Extension:
-            # If we've found an extension, we need to go deeper.
-            if path.starts_with(node.path):
-                rest_path = path.consume(len(node.path))
-                return self._get(node.next_ref, rest_path)
+    def _get(self, node_ref, path):
+        """ Get support method """
+        while True:
+            node = self._get_node(node_ref)
 
-        elif type(node) is Node.Branch:
-            # If we've found a branch node, go to the appropriate branch.
-            branch = node.branches[path.at(0)]
-            if len(branch) > 0:
-                return self._get(branch, path.consume(1))
+            # If path is empty, our travel is over. Main `get` method will check if this node has a value.
+            if len(path) == 0:
+                return node
 
-        # Raise error if it's a wrong node, extension with different path or branch node without appropriate branch.
-        raise KeyError
+            if type(node) is Node.Leaf:
+                # If we've found a leaf, it's either the leaf we're looking for or wrong leaf.
+                if node.path == path:
+                    return node
+
+            elif type(node) is Node.Extension:
+                # If we've found an extension, we need to go deeper.
+                if path.starts_with(node.path):
+                    node_ref = node.next_ref
+                    path = path[len(node.path):]
+                    continue
+
+            elif type(node) is Node.Branch:
+                # If we've found a branch node, go to the appropriate branch.
+                branch = node.branch(path.at(0))
+                if branch:
+                    node_ref = branch
+                    path = path[1:]
+                    continue
+
+            # Raise error if it's a wrong node, extension with different path or branch node without appropriate branch.
+            raise KeyError
 
     def _update(self, node_ref, path, value):
-        """ Update support method """
-        if not node_ref:
-            return self._store_node(Node.Leaf(path, value))
+        """
+        Update support method.
 
-        node = self._get_node(node_ref)
+        Goes down the trie remembering passed extension and branch nodes on the stack, replaces the node
+        where the key ends or diverges and then rebuilds the modified nodes bottom-up.
+        """
+        # Stack of (node, index of the branch we went to). Index is `None` for extension nodes.
+        stack = []
 
-        if type(node) == Node.Leaf:
-            # If we're updating the leaf there are 2 possible ways:
-            # 1. Path is equals to the rest of the key. Then we should just update value of this leaf.
-            # 2. Path differs. Then we should split this node into several nodes.
+        while True:
+            if not node_ref:
+                reference = self._store_node(Node.Leaf(path, value))
+                break
 
-            if node.path == path:
-                # Path is the same. Just change the value.
-                node.data = value
-                return self._store_node(node)
+            node = self._get_node(node_ref)
 
-            # If we are here, we have to split the node.
+            if type(node) == Node.Leaf:
+                reference = self._update_leaf(node, path, value)
+                break
 
-            # Find the common part of the key and leaf's path.
-            common_prefix = path.common_prefix(node.path)
+            elif type(node) == Node.Extension:
+                # If we're updating an extenstion there are 2 possible ways:
+                # 1. Key starts with the extension node's path. Then we just go ahead.
+                # 2. Key doesn't start with extension node's path. Then we have to split extension node.
+                if not path.starts_with(node.path):
+                    reference = self._split_extension(node, path, value)
+                    break
+
+                stack.append((node, None))
+                node_ref = node.next_ref
+                path = path[len(node.path):]
+
+            elif type(node) == Node.Branch:
+                # For branch node things are easy.
+                # 1. If key is empty, just store value in this node.
+                # 2. If key isn't empty, just go ahead with appropiate branch reference.
+                if len(path) == 0:
+                    reference = self._store_node(node.with_data(value))
+                    break
 
-            # Cut off the common part.
-            path.consume(len(common_prefix))
-            node.path.consume(len(common_prefix))
+                idx = path.at(0)
+                stack.append((node, idx))
+                node_ref = node.branch(idx)
+                path = path[1:]
 
-            # Create branch node to split paths.
-            branch_reference = self._create_branch_node(path, value, node.path, node.data)
+        return self._rebuild_spine(stack, reference)
 
-            # If common part isn't empty, we have to create an extension node before branch node.
-            # Otherwise, we need just branch node.
-            if len(common_prefix) != 0:
-                return self._store_node(Node.Extension(common_prefix, branch_reference))
+    def _rebuild_spine(self, stack, reference):
+        """ Updates references in the passed nodes bottom-up. Returns the reference to the new top node. """
+        for node, idx in reversed(stack):
+            if idx is None:
+                reference = self._store_node(node.with_next_ref(reference))
             else:
-                return branch_reference
+                reference = self._store_node(node.with_branch(idx, reference))
 
-        elif type(node) == Node.Extension:
-            # If we're updating an extenstion there are 2 possible ways:
-            # 1. Key starts with the extension node's path. Then we just go ahead and all the work will be done there.
-            # 2. Key doesn't start with extension node's path. Then we have to split extension node.
+        return reference
 
-            if path.starts_with(node.path):
-                # Just go ahead.
-                new_reference = self._update(node.next_ref, path.consume(len(node.path)), value)
-                return self._store_node(Node.Extension(node.path, new_reference))
+    def _update_leaf(self, node, path, value):
+        """ Updates the value of the leaf or splits it if the paths differ. Returns the reference to the new node. """
+        # If we're updating the leaf there are 2 possible ways:
+        # 1. Path is equals to the rest of the key. Then we should just update value of this leaf.
+        # 2. Path differs. Then we should split this node into several nodes.
 
-            # Split extension node.
+        if node.path == path:
+            # Path is the same. Just change the value.
+            return self._store_node(node.with_data(value))
 
-            # Find the common part of the key and extension's path.
-            common_prefix = path.common_prefix(node.path)
+        # If we are here, we have to split the node.
 
-            # Cut off the common part.
-            path.consume(len(common_prefix))
-            node.path.consume(len(common_prefix))
+        # Find the common part of the key and leaf's path.
+        common_prefix = path.common_prefix(node.path)
 
-            # Create an empty branch node. It may have or have not the value depending on the length
-            # of the rest of the key.
-            branches = [b''] * 16
-            branch_value = value if len(path) == 0 else b''
+        # Cut off the common part.
+        path = path[len(common_prefix):]
+        node_path = node.path[len(common_prefix):]
 
-            # If needed, create leaf branch for the value we're inserting.
-            self._create_branch_leaf(path, value, branches)
-            # If needed, create an extension node for the rest of the extension's path.
-            self._create_branch_extension(node.path, node.next_ref, branches)
+        # Create branch node to split paths.
+        branch_reference = self._create_branch_node(path, value, node_path, node.data)
 
-            branch_reference = self._store_node(Node.Branch(branches, branch_value))
+        # If common part isn't empty, we have to create an extension node before branch node.
+        # Otherwise, we need just branch node.
+        if len(common_prefix) != 0:
+            return self._store_node(Node.Extension(common_prefix, branch_reference))
+        else:
+            return branch_reference
 
-            # If common part isn't empty, we have to create an extension node before branch node.
-            # Otherwise, we need just branch node.
-            if len(common_prefix) != 0:
-                return self._store_node(Node.Extension(common_prefix, branch_reference))
-            else:
-                return branch_reference
+    def _split_extension(self, node, path, value):
+        """ Splits the extension node which path differs from the key. Returns the reference to the new node. """
+        # Find the common part of the key and extension's path.
+        common_prefix = path.common_prefix(node.path)
 
-        elif type(node) == Node.Branch:
-            # For branch node things are easy.
-            # 1. If key is empty, just store value in this node.
-            # 2. If key isn't empty, just call `_update` with appropiate branch reference.
+        # Cut off the common part.
+        path = path[len(common_prefix):]
+        node_path = node.path[len(common_prefix):]
 
-            if len(path) == 0:
-                return self._store_node(Node.Branch(node.branches, value))
+        # Create an empty branch node. It may have or have not the value depending on the length
+        # of the rest of the key.
+        branches = [b''] * 16
+        branch_value = value if len(path) == 0 else b''
 
-            idx = path.at(0)
-            new_reference = self._update(node.branches[idx], path.consume(1), value)
+        # If needed, create leaf branch for the value we're inserting.
+        self._create_branch_leaf(path, value, branches)
+        # If needed, create an extension node for the rest of the extension's path.
+        self._create_branch_extension(node_path, node.next_ref, branches)
 
-            node.branches[idx] = new_reference
+        branch_reference = self._store_node(Node.Branch(branches, branch_value))
 
-            return self._store_node(node)
+        # If common part isn't empty, we have to create an extension node before branch node.
+        # Otherwise, we need just branch node.
+        if len(common_prefix) != 0:
+            return self._store_node(Node.Extension(common_prefix, branch_reference))
+        else:
+            return branch_reference
 
     def _create_branch_node(self, path_a, value_a, path_b, value_b):
         """ Creates a branch node with up to two leaves and maybe value. Returns a reference to created node. """
@@ -288,7 +1052,7 @@ class MerklePatriciaTrie:
         if len(path) > 0:
             idx = path.at(0)
 
-            leaf_ref = self._store_node(Node.Leaf(path.consume(1), value))
+            leaf_ref = self._store_node(Node.Leaf(path[1:], value))
             branches[idx] = leaf_ref
 
     def _create_branch_extension(self, path, next_ref, branches):
@@ -302,16 +1066,217 @@ class MerklePatriciaTrie:
             branches[path.at(0)] = next_ref
         else:
             idx = path.at(0)
-            reference = self._store_node(Node.Extension(path.consume(1), next_ref))
+            reference = self._store_node(Node.Extension(path[1:], next_ref))
             branches[idx] = reference
 
     def _store_node(self, node):
-        """ Builds the reference from the node and if needed saves node in the storage. """
+        """
+        Builds the reference from the node and if needed saves node in the storage.
+
+        In batch mode the node itself is used as a reference until the batch is committed.
+        """
+        if self._batching:
+            return node
+
+        return self._write_node(node)
+
+    def _write_node(self, node):
+        """ Encodes the node, builds the reference to it and if needed saves node in the storage. """
+        # Encoding is memoized in the node, so it's encoded only once here.
         reference = Node.into_reference(node)
-        if len(reference) == 32:
-            self._storage[reference] = node.encode()
+        if len(reference) < 32:
+            return reference
+
+        encoded_node = node.encode()
+        if self._write_queue is not None:
+            self._write_queue.append((reference, encoded_node))
+        else:
+            self._storage[reference] = encoded_node
+        if self._cache is not None:
+            self._cache.put(reference, node, len(encoded_node))
+        if self._pruner is not None and not self._checkpoints:
+            self._pruner.node_written(reference, node)
         return reference
 
+    def _flush_writes(self):
+        """ Stores all the queued nodes, using bulk write if storage supports it. """
+        writes, self._write_queue = self._write_queue, []
+        if not writes:
+            return
+
+        put_many = getattr(self._storage, 'put_many', None)
+        if put_many is not None:
+            put_many(writes)
+        else:
+            for reference, encoded_node in writes:
+                self._storage[reference] = encoded_node
+
+    def _commit_node(self, node_ref, executor=None):
+        """ Writes dirty node and all its dirty children bottom-up. Returns the reference to the written node. """
+        if node_ref is None or isinstance(node_ref, bytes):
+            return node_ref
+
+        keep_nodes = self._cache is not None or self._pruner is not None
+
+        # Subtrees hashed by the executor. References to them are known before the top nodes are encoded.
+        references = {}
+        if executor is not None:
+            subtrees = MerklePatriciaTrie._split_dirty(node_ref)
+            results = executor.map(MerklePatriciaTrie._encode_dirty, subtrees, [None] * len(subtrees),
+                                   [keep_nodes] * len(subtrees))
+
+            for subtree, (reference, writes) in zip(subtrees, results):
+                references[id(subtree)] = reference
+                self._queue_writes(writes)
+
+        reference, writes = MerklePatriciaTrie._encode_dirty(node_ref, references, keep_nodes)
+        self._queue_writes(writes)
+
+        return reference
+
+    # Dirty subtrees are split until there are at least this amount of them to hash in parallel.
+    _PARALLEL_SUBTREES = 64
+
+    def _split_dirty(node):
+        """
+        Returns the dirty subtrees under the top branch levels of the dirty node.
+
+        Each level of the branches multiplies the amount of subtrees by up to 16. Nodes with the same hash
+        don't depend on each other, so subtrees may be encoded and hashed independently.
+        """
+        subtrees = [node]
+
+        while len(subtrees) < MerklePatriciaTrie._PARALLEL_SUBTREES:
+            next_subtrees = []
+            for subtree in subtrees:
+                if type(subtree) == Node.Extension:
+                    children = (subtree.next_ref,)
+                elif type(subtree) == Node.Branch:
+                    children = subtree.branches
+                else:
+                    # Leaves are tiny, there is no point to split further.
+                    children = ()
+
+                next_subtrees.extend(child for child in children if child and not isinstance(child, bytes))
+
+            if not next_subtrees:
+                break
+            subtrees = next_subtrees
+
+        # Whole trie is a single subtree, it will be encoded by the caller.
+        return [subtree for subtree in subtrees if subtree is not node]
+
+    def _encode_dirty(node_ref, references=None, keep_nodes=True):
+        """
+        Encodes and hashes dirty node and all its dirty children bottom-up without touching the storage.
+
+        `references` maps ids of already encoded dirty nodes to their references. Returns the reference
+        to the node and the list of (reference, encoded node, node) to write. Node is `None` if `keep_nodes`
+        isn't set. This function has no side effects, so it may be run by the executor in other process.
+        """
+        if references is None:
+            references = {}
+
+        # Collect dirty nodes so that every node goes before its children.
+        dirty_nodes = []
+        pending = [node_ref]
+        while pending:
+            node = pending.pop()
+            if id(node) in references:
+                continue
+
+            dirty_nodes.append(node)
+
+            if type(node) == Node.Extension:
+                children = (node.next_ref,)
+            elif type(node) == Node.Branch:
+                children = node.branches
+            else:
+                children = ()
+
+            pending.extend(child for child in children if child and not isinstance(child, bytes))
+
+        def committed(ref):
+            if not ref or isinstance(ref, bytes):
+                return ref
+            return references[id(ref)]
+
+        # Encode nodes in reverse order, so children are encoded before parents.
+        writes = []
+        for node in reversed(dirty_nodes):
+            if type(node) == Node.Extension:
+                new_node = node.with_next_ref(committed(node.next_ref))
+            elif type(node) == Node.Branch:
+                new_node = Node.Branch(map(committed, node.branches), node.data)
+            else:
+                new_node = node
+
+            # Encoding is memoized in the node, so it's encoded only once here.
+            reference = Node.into_reference(new_node)
+            if len(reference) == 32:
+                writes.append((reference, new_node.encode(), new_node if keep_nodes else None))
+
+            references[id(node)] = reference
+
+        return references[id(node_ref)], writes
+
+    def _queue_writes(self, writes):
+        """ Queues encoded nodes for writing and registers them in the cache and the pruner. """
+        for reference, encoded_node, node in writes:
+            self._write_queue.append((reference, encoded_node))
+            if self._cache is not None:
+                self._cache.put(reference, node, len(encoded_node))
+            if self._pruner is not None and not self._checkpoints:
+                self._pruner.node_written(reference, node)
+
+    # Maximum amount of nodes queued by `from_sorted_items` before they are written to the storage.
+    _WRITE_CHUNK = 10000
+
+    class _BranchFrame:
+        """ Branch node that is being built by `from_sorted_items`. """
+
+        def __init__(self, prefix):
+            self.prefix = prefix
+            self.depth = len(prefix)
+            self.branches = [b''] * 16
+            self.data = b''
+
+    def _add_sorted_item(self, stack, key, value, common_len):
+        """
+        Adds a leaf to the deepest branch on the stack and builds all the branches deeper than `common_len`.
+        After that the top of the stack is the branch at depth `common_len`.
+        """
+        if not stack or stack[-1].depth < common_len:
+            stack.append(MerklePatriciaTrie._BranchFrame(key[:common_len]))
+
+        self._attach_sorted_leaf(stack[-1], key, value)
+
+        while stack[-1].depth > common_len:
+            frame = stack.pop()
+
+            if not stack or stack[-1].depth < common_len:
+                stack.append(MerklePatriciaTrie._BranchFrame(key[:common_len]))
+
+            self._attach_sorted_branch(stack[-1], frame)
+
+    def _attach_sorted_leaf(self, frame, key, value):
+        """ Stores a value either in the branch itself or in the leaf node under the branch. """
+        if len(key) == frame.depth:
+            frame.data = value
+        else:
+            leaf = Node.Leaf(_path_from_nibbles(key[frame.depth + 1:]), value)
+            frame.branches[int(key[frame.depth], 16)] = self._store_node(leaf)
+
+    def _attach_sorted_branch(self, parent, frame):
+        """ Builds a finished branch and stores reference to it (via extension node if needed) in the parent. """
+        reference = self._store_node(Node.Branch(frame.branches, frame.data))
+
+        if frame.depth > parent.depth + 1:
+            path = _path_from_nibbles(frame.prefix[parent.depth + 1:])
+            reference = self._store_node(Node.Extension(path, reference))
+
+        parent.branches[int(frame.prefix[parent.depth], 16)] = reference
+
     # Enum that shows which action was performed on the previous step of the deletion.
     class _DeleteAction(Enum):
         # Node was deleted. Returned value should be (_DeleteAction, None).
@@ -322,132 +1287,157 @@ class MerklePatriciaTrie:
         USELESS_BRANCH = 3
 
     def _delete(self, node_ref, path):
-        """ Delete method helper """
+        """
+        Delete method helper.
 
-        node = self._get_node(node_ref)
+        Goes down the trie remembering passed extension and branch nodes on the stack, removes the value
+        and then goes back up propagating the performed action to the parent nodes.
+        Nothing is written to the storage if the key is not found.
+        """
+        # Stack of (node, index of the branch we went to). Index is `None` for extension nodes.
+        stack = []
 
-        if type(node) == Node.Leaf:
-            # If it's leaf node, then it's either node we need or incorrect key provided.
-            if path == node.path:
-                return MerklePatriciaTrie._DeleteAction.DELETED, None
-            else:
-                raise KeyError
-
-        elif type(node) == Node.Extension:
-            # Extension node can't be removed directly, it passes delete request to the next node.
-            # After that several options are possible:
-            # 1. Next node was deleted. Then this node should be deleted too.
-            # 2. Next node was updated. Then we should update stored reference.
-            # 3. Next node was useless branch. Then we have to update our node depending on the next node type.
-
-            if not path.starts_with(node.path):
-                raise KeyError
-
-            action, info = self._delete(node.next_ref, path.consume(len(node.path)))
-
-            if action == MerklePatriciaTrie._DeleteAction.DELETED:
-                # Next node was deleted. This node should be deleted also.
-                return action, None
-            elif action == MerklePatriciaTrie._DeleteAction.UPDATED:
-                # Next node was updated. Update this node too.
-                child_ref = info
-                new_ref = self._store_node(Node.Extension(node.path, child_ref))
-                return action, new_ref
-            elif action == MerklePatriciaTrie._DeleteAction.USELESS_BRANCH:
-                # Next node was useless branch.
-                stored_path, stored_ref = info
-
-                child = self._get_node(stored_ref)
-
-                new_node = None
-                if type(child) == Node.Leaf:
-                    # If next node is the leaf, our node is unnecessary.
-                    # Concat our path with leaf path and return reference to the leaf.
-                    path = NibblePath.combine(node.path, child.path)
-                    new_node = Node.Leaf(path, child.data)
-                elif type(child) == Node.Extension:
-                    # If next node is the extension, merge this and next node into one.
-                    path = NibblePath.combine(node.path, child.path)
-                    new_node = Node.Extension(path, child.next_ref)
-                elif type(child) == Node.Branch:
-                    # If next node is the branch, concatenate paths and update stored reference.
-                    path = NibblePath.combine(node.path, stored_path)
-                    new_node = Node.Extension(path, stored_ref)
-
-                new_reference = self._store_node(new_node)
-                return MerklePatriciaTrie._DeleteAction.UPDATED, new_reference
-
-        elif type(node) == Node.Branch:
-            # For branch node things are quite complicated.
-            # If rest of the key is empty and there is stored value, just clear value field.
-            # Otherwise call _delete for the appropriate branch.
-            # At this step we will have delete action and (possibly) index of the branch we're working with.
-            #
-            # Then, if next node was updated or was useless branch, just update reference.
-            # If `_DeleteAction` is `DELETED` then either the next node or value of this node was removed.
-            # We have to check if there is at least 2 branches or 1 branch and value still persist in this node.
-            # If there are no branches and no value left, delete this node completely.
-            # If there is a value but no branches, create leaf node with value and empty path
-            # and return `USELESS_BRANCH` action.
-            # If there is an only branch and no value, merge nibble of this branch and path of the underlying node
-            # and return `USELESS_BRANCH` action.
-            # Otherwise our branch isn't useless and was updated.
-
-            action = None
-            idx = None
-            info = None
-
-            assert len(path) != 0 or len(node.data) != 0, "Empty path or empty branch node in _delete"
-
-            # Decide if we need to remove value of this node or go deeper.
-            if len(path) == 0 and len(node.data) == 0:
-                # This branch node has no value thus we can't delete it.
-                raise KeyError
-            elif len(path) == 0 and len(node.data) != 0:
-                node.data = b''
-                action = MerklePatriciaTrie._DeleteAction.DELETED
-            else:
-                # Store idx of the branch we're working with.
-                idx = path.at(0)
+        while True:
+            node = self._get_node(node_ref)
 
-                if len(node.branches[idx]) == 0:
+            if type(node) == Node.Leaf:
+                # If it's leaf node, then it's either node we need or incorrect key provided.
+                if path != node.path:
                     raise KeyError
 
-                action, info = self._delete(node.branches[idx], path.consume(1))
-                node.branches[idx] = b''
+                action, info = MerklePatriciaTrie._DeleteAction.DELETED, None
+                break
 
-            if action == MerklePatriciaTrie._DeleteAction.DELETED:
-                non_empty_count = sum(map(lambda x: 1 if len(x) > 0 else 0, node.branches))
+            elif type(node) == Node.Extension:
+                # Extension node can't be removed directly, it passes delete request to the next node.
+                if not path.starts_with(node.path):
+                    raise KeyError
 
-                if non_empty_count == 0 and len(node.data) == 0:
-                    # Branch node is empty, just delete it.
-                    return MerklePatriciaTrie._DeleteAction.DELETED, None
-                elif non_empty_count == 0 and len(node.data) != 0:
-                    # No branches, just value.
-                    path = NibblePath([])
-                    reference = self._store_node(Node.Leaf(path, node.data))
+                stack.append((node, None))
+                node_ref = node.next_ref
+                path = path[len(node.path):]
 
-                    return MerklePatriciaTrie._DeleteAction.USELESS_BRANCH, (path, reference)
-                elif non_empty_count == 1 and len(node.data) == 0:
-                    # No value and one branch
-                    return self._build_new_node_from_last_branch(node.branches)
-                else:
-                    # Branch has value and 1+ branches or no value and 2+ branches.
-                    # It isn't useless, so action is `UPDATED`.
-                    reference = self._store_node(node)
-                    return MerklePatriciaTrie._DeleteAction.UPDATED, reference
-            elif action == MerklePatriciaTrie._DeleteAction.UPDATED:
-                # Just update reference.
-                next_ref = info
-                node.branches[idx] = next_ref
-                reference = self._store_node(node)
-                return MerklePatriciaTrie._DeleteAction.UPDATED, reference
-            elif action == MerklePatriciaTrie._DeleteAction.USELESS_BRANCH:
-                # Just update reference.
-                _, next_ref = info
-                node.branches[idx] = next_ref
-                reference = self._store_node(node)
-                return MerklePatriciaTrie._DeleteAction.UPDATED, reference
+            elif type(node) == Node.Branch:
+                # If rest of the key is empty and there is stored value, just clear value field.
+                # Otherwise go to the appropriate branch.
+                if len(path) == 0:
+                    if len(node.data) == 0:
+                        # This branch node has no value thus we can't delete it.
+                        raise KeyError
+
+                    action, info = self._delete_branch_value(list(node.branches))
+                    break
+
+                idx = path.at(0)
+                if not node.branch(idx):
+                    raise KeyError
+
+                stack.append((node, idx))
+                node_ref = node.branch(idx)
+                path = path[1:]
+
+        for node, idx in reversed(stack):
+            if idx is None:
+                action, info = self._delete_from_extension(node, action, info)
+            else:
+                action, info = self._delete_from_branch(node, idx, action, info)
+
+        return action, info
+
+    def _delete_from_extension(self, node, action, info):
+        """ Updates the extension node after the deletion in the next node. """
+        # Several options are possible:
+        # 1. Next node was deleted. Then this node should be deleted too.
+        # 2. Next node was updated. Then we should update stored reference.
+        # 3. Next node was useless branch. Then we have to update our node depending on the next node type.
+
+        if action == MerklePatriciaTrie._DeleteAction.DELETED:
+            # Next node was deleted. This node should be deleted also.
+            return action, None
+        elif action == MerklePatriciaTrie._DeleteAction.UPDATED:
+            # Next node was updated. Update this node too.
+            child_ref = info
+            new_ref = self._store_node(node.with_next_ref(child_ref))
+            return action, new_ref
+        elif action == MerklePatriciaTrie._DeleteAction.USELESS_BRANCH:
+            # Next node was useless branch.
+            stored_path, stored_ref = info
+
+            child = self._get_node(stored_ref)
+
+            new_node = None
+            if type(child) == Node.Leaf:
+                # If next node is the leaf, our node is unnecessary.
+                # Concat our path with leaf path and return reference to the leaf.
+                path = NibblePath.combine(node.path, child.path)
+                new_node = Node.Leaf(path, child.data)
+            elif type(child) == Node.Extension:
+                # If next node is the extension, merge this and next node into one.
+                path = NibblePath.combine(node.path, child.path)
+                new_node = Node.Extension(path, child.next_ref)
+            elif type(child) == Node.Branch:
+                # If next node is the branch, concatenate paths and update stored reference.
+                path = NibblePath.combine(node.path, stored_path)
+                new_node = Node.Extension(path, stored_ref)
+
+            new_reference = self._store_node(new_node)
+            return MerklePatriciaTrie._DeleteAction.UPDATED, new_reference
+
+    def _delete_from_branch(self, node, idx, action, info):
+        """ Updates the branch node after the deletion in the branch with index `idx`. """
+        # If next node was updated or was useless branch, just update reference.
+        # If `_DeleteAction` is `DELETED`, the branch should be removed, and this node may become useless.
+
+        # Nodes are immutable, so all the changes are made on the copy.
+        branches = list(node.branches)
+
+        if action == MerklePatriciaTrie._DeleteAction.DELETED:
+            branches[idx] = b''
+            return self._delete_branch_value(branches, node.data)
+        elif action == MerklePatriciaTrie._DeleteAction.UPDATED:
+            # Just update reference.
+            next_ref = info
+            branches[idx] = next_ref
+            reference = self._store_node(Node.Branch(branches, node.data))
+            return MerklePatriciaTrie._DeleteAction.UPDATED, reference
+        elif action == MerklePatriciaTrie._DeleteAction.USELESS_BRANCH:
+            # Just update reference.
+            _, next_ref = info
+            branches[idx] = next_ref
+            reference = self._store_node(Node.Branch(branches, node.data))
+            return MerklePatriciaTrie._DeleteAction.UPDATED, reference
+
+    def _delete_branch_value(self, branches, data=b''):
+        """
+        Builds the branch node after either its value or one of its branches was removed.
+
+        We have to check if there is at least 2 branches or 1 branch and value still persist in this node.
+        If there are no branches and no value left, delete this node completely.
+        If there is a value but no branches, create leaf node with value and empty path
+        and return `USELESS_BRANCH` action.
+        If there is an only branch and no value, merge nibble of this branch and path of the underlying node
+        and return `USELESS_BRANCH` action.
+        Otherwise our branch isn't useless and was updated.
+        """
+        non_empty_count = sum(map(lambda x: 1 if x else 0, branches))
+
+        if non_empty_count == 0 and len(data) == 0:
+            # Branch node is empty, just delete it.
+            return MerklePatriciaTrie._DeleteAction.DELETED, None
+        elif non_empty_count == 0 and len(data) != 0:
+            # No branches, just value.
+            path = NibblePath([])
+            reference = self._store_node(Node.Leaf(path, data))
+
+            return MerklePatriciaTrie._DeleteAction.USELESS_BRANCH, (path, reference)
+        elif non_empty_count == 1 and len(data) == 0:
+            # No value and one branch
+            return self._build_new_node_from_last_branch(branches)
+        else:
+            # Branch has value and 1+ branches or no value and 2+ branches.
+            # It isn't useless, so action is `UPDATED`.
+            reference = self._store_node(Node.Branch(branches, data))
+            return MerklePatriciaTrie._DeleteAction.UPDATED, reference
 
     def _build_new_node_from_last_branch(self, branches):
         """ Combines nibble of the only branch left with underlying node and creates new node. """
@@ -455,7 +1445,7 @@ class MerklePatriciaTrie:
         # Find the index of the only stored branch.
         idx = 0
         for i in range(len(branches)):
-            if len(branches[i]) > 0:
+            if branches[i]:
                 idx = i
                 break
 
@@ -483,3 +1473,27 @@ class MerklePatriciaTrie:
         reference = self._store_node(node)
 
         return MerklePatriciaTrie._DeleteAction.USELESS_BRANCH, (path, reference)
+
+
+def _path_from_nibbles(nibbles):
+    """ Creates NibblePath from a string of hex digits, each digit is a nibble. """
+    if len(nibbles) % 2 == 1:
+        return NibblePath(bytes.fromhex('0' + nibbles), offset=1)
+
+    return NibblePath(bytes.fromhex(nibbles))
+
+
+# Amount of keys hashed at once by `_hashed_keys`.
+_HASH_CHUNK = 1024
+
+
+def _hashed_keys(items):
+    """ Yields (key, value) pairs with keys hashed using keccak256. Keys are hashed in chunks. """
+    items = iter(items)
+
+    while True:
+        chunk = list(islice(items, _HASH_CHUNK))
+        if not chunk:
+            return
+
+        yield from zip(keccak_hash_many([key for key, _ in chunk]), [value for _, value in chunk])
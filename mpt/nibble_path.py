@@ -1,31 +1,65 @@
 class NibblePath:
+    """
+    Immutable path of nibbles.
+
+    Path is a view over the bytes: slicing (e.g. `path[1:]`) creates a new view and never copies the underlying
+    data, so paths can be freely shared between nodes, tries and threads.
+    """
+
+    __slots__ = ('_data', '_offset', '_length')
+
     ODD_FLAG = 0x10
     LEAF_FLAG = 0x20
 
-    def __init__(self, data, offset=0):
+    def __init__(self, data, offset=0, length=None):
+        """
+        Creates a path of nibbles stored in `data` starting from the nibble with index `offset`.
+        If `length` isn't provided, path lasts until the end of `data`.
+        """
+        if isinstance(data, list):
+            data = bytes(data)
+
         self._data = data
         self._offset = offset
+        self._length = len(data) * 2 - offset if length is None else length
 
     def __len__(self):
-        return len(self._data) * 2 - self._offset
+        return self._length
 
     def __repr__(self):
-        return "<NibblePath: Data: 0x{}, Offset: {}>".format(self._data.hex(), self._offset)
+        return "<NibblePath: Data: 0x{}, Offset: {}, Length: {}>".format(
+            bytes(self._data).hex(), self._offset, self._length)
 
     def __str__(self):
-        # Convert each nibble in the list to its hexadecimal representation
-        hex_string = ''.join(f'{nibble:02x}' for nibble in self._data)
-        return f'<Hex 0x{hex_string} | Raw {self._data}>'
+        return '<Hex 0x{} | Raw {}>'.format(self.hex(), bytes(self._data))
 
     def __eq__(self, other):
-        if len(self) != len(other):
+        if not isinstance(other, NibblePath):
+            return NotImplemented
+
+        if self._length != other._length:
             return False
 
-        for i in range(len(self)):
-            if self.at(i) != other.at(i):
-                return False
+        return self._value() == other._value()
+
+    def __hash__(self):
+        return hash((self._length, self._value()))
+
+    def __getitem__(self, key):
+        """ Returns a nibble at the certain position or a view over the part of the path for slices. """
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._length)
+            if step != 1:
+                raise ValueError("NibblePath doesn't support slices with step")
+
+            return NibblePath(self._data, self._offset + start, max(stop - start, 0))
 
-        return True
+        if key < 0:
+            key += self._length
+        if not 0 <= key < self._length:
+            raise IndexError("NibblePath index out of range")
+
+        return self.at(key)
 
     def decode_with_type(data):
         """ Decodes NibblePath and its type from raw bytes. """
@@ -40,66 +74,66 @@ class NibblePath:
         """ Decodes NibblePath without its type from raw bytes. """
         return NibblePath.decode_with_type(data)[0]
 
-    def starts_with(self, other):
-        """ Checks if `other` is prefix of `self`. """
-        if len(other) > len(self):
-            return False
+    def _value(self, length=None):
+        """
+        Returns first `length` nibbles of the path (the whole path by default) as an integer.
 
-        for i in range(len(other)):
-            if self.at(i) != other.at(i):
-                return False
+        Comparing integers compares all the nibbles at once, whatever the offsets of the paths are.
+        """
+        if length is None:
+            length = self._length
 
-        return True
+        if length == 0:
+            return 0
 
-    def at(self, idx):
-        """ Returns nibble at the certain position. """
-        idx = idx + self._offset
+        start = self._offset
+        end = start + length
 
-        byte_idx = idx // 2
-        nibble_idx = idx % 2
+        value = int.from_bytes(self._data[start >> 1:(end + 1) >> 1], 'big')
 
-        byte = self._data[byte_idx]
+        # Cut off the lower nibble of the last byte if it isn't a part of the path.
+        if end & 1:
+            value >>= 4
 
-        nibble = byte >> 4 if nibble_idx == 0 else byte & 0x0F
-        """
-        Masking the upper lower part with logical right shift when nibble_idx == 0 and lower part with bitwise AND against 0x0F while nibble_idx == 1
-        """
-        return nibble
+        # Cut off the higher nibble of the first byte if it isn't a part of the path.
+        return value & ((1 << (length << 2)) - 1)
 
-    def consume(self, amount):
-        """ Cuts off nibbles at the beginning of the path. """
-        self._offset += amount
-        return self
+    def _from_value(value, length):
+        """ Creates a new NibblePath with a certain length from the integer. """
+        return NibblePath(value.to_bytes((length + 1) >> 1, 'big'), length & 1)
 
-    def _create_new(path, length):
-        """ Creates a new NibblePath from a given object with a certain length. """
-        data = []
+    def hex(self):
+        """ Returns nibbles of the path as a string of hex digits. """
+        if self._length == 0:
+            return ''
 
-        is_odd_len = length % 2 == 1
-        pos = 0
+        return '{:0{}x}'.format(self._value(), self._length)
 
-        if is_odd_len:
-            data.append(path.at(pos))
-            pos += 1
+    def starts_with(self, other):
+        """ Checks if `other` is prefix of `self`. """
+        if len(other) > len(self):
+            return False
 
-        while pos < length:
-            data.append(path.at(pos) * 16 + path.at(pos + 1))
-            pos += 2
+        return self._value(len(other)) == other._value()
 
-        offset = 1 if is_odd_len else 0
+    def at(self, idx):
+        """ Returns nibble at the certain position. """
+        idx = idx + self._offset
 
-        return NibblePath(data, offset)
+        byte = self._data[idx >> 1]
+
+        # Higher nibble is on the even position and the lower one is on the odd position.
+        return byte & 0x0F if idx & 1 else byte >> 4
 
     def common_prefix(self, other):
-        """ Returns common part at the beginning of both paths. """
+        """ Returns common part at the beginning of both paths. Result is a view over `self`. """
         least_len = min(len(self), len(other))
-        common_len = 0
-        for i in range(least_len):
-            if self.at(i) != other.at(i):
-                break
-            common_len += 1
 
-        return NibblePath._create_new(self, common_len)
+        # Highest non-zero nibble of the xor is the first nibble that differs.
+        diff = self._value(least_len) ^ other._value(least_len)
+        common_len = least_len - ((diff.bit_length() + 3) >> 2)
+
+        return NibblePath(self._data, self._offset, common_len)
 
     def encode(self, is_leaf):
         """
@@ -108,43 +142,23 @@ class NibblePath:
         Encoded path contains prefix with flags of type and length and also may contain a padding nibble
         so the length of encoded path is always even.
         """
-        output = []
-
         nibbles_len = len(self)
         is_odd = nibbles_len % 2 == 1
 
         prefix = 0x00
-        prefix += self.ODD_FLAG + self.at(0) if is_odd else 0x00
+        prefix += self.ODD_FLAG if is_odd else 0x00
         prefix += self.LEAF_FLAG if is_leaf else 0x00
 
-        output.append(prefix)
-
-        pos = nibbles_len % 2
-
-        while pos < nibbles_len:
-            byte = self.at(pos) * 16 + self.at(pos + 1)
-            output.append(byte)
-            pos += 2
-
-        return bytes(output)
-
-    class _Chained:
-        """ Class that chains two paths. """
-
-        def __init__(self, first, second):
-            self.first = first
-            self.second = second
-
-        def __len__(self):
-            return len(self.first) + len(self.second)
+        if is_odd:
+            # Prefix nibble is followed by the first nibble of the path.
+            value = (prefix >> 4 << (nibbles_len << 2)) | self._value()
+        else:
+            # Prefix nibble is followed by the padding nibble.
+            value = (prefix << (nibbles_len << 2)) | self._value()
 
-        def at(self, idx):
-            if idx < len(self.first):
-                return self.first.at(idx)
-            else:
-                return self.second.at(idx - len(self.first))
+        return value.to_bytes((nibbles_len >> 1) + 1, 'big')
 
     def combine(self, other):
         """ Merges two paths into one. """
-        chained = NibblePath._Chained(self, other)
-        return NibblePath._create_new(chained, len(chained))
+        value = (self._value() << (len(other) << 2)) | other._value()
+        return NibblePath._from_value(value, len(self) + len(other))
@@ -1,70 +1,366 @@
-import rlp
+from .backends import get_backend, register_backend
 from .nibble_path import NibblePath
 from .hash import keccak_hash
 
 
-def _prepare_reference_for_usage(ref):
-    """ Encodes reference into RLP if needed so stored references will appear as bytes. """
-    if isinstance(ref, list):
-        return rlp.encode(ref)
+def _encode_length(length, offset):
+    """ Returns RLP prefix of the string (offset 0x80) or list (offset 0xc0) with the given payload length. """
+    if length < 56:
+        return bytes([offset + length])
 
-    return ref
+    length_bytes = length.to_bytes((length.bit_length() + 7) >> 3, 'big')
+    return bytes([offset + 55 + len(length_bytes)]) + length_bytes
+
+
+def _encode_string(data):
+    """ Encodes byte string into RLP. """
+    if len(data) == 1 and data[0] < 0x80:
+        # Single byte below 0x80 is its own encoding.
+        return bytes(data)
 
+    return _encode_length(len(data), 0x80) + data
 
-def _prepare_reference_for_encoding(ref):
-    """ Decodes RLP-encoded reference if needed so the full node will be encoded correctly. """
-    if 0 < len(ref) < 32:
-        return rlp.decode(ref)
+
+def _encode_reference(ref):
+    """ Encodes reference into RLP. Inline node is already encoded, so it's inserted as is. """
+    if len(ref) == 32:
+        return b'\xa0' + ref
+    if not ref:
+        return b'\x80'
 
     return ref
 
 
+def _item_bounds(data, position):
+    """
+    Parses RLP prefix of the item starting at the position.
+
+    Returns a tuple (is list, payload start, item end). Raises ValueError if the item is malformed.
+    """
+    if position >= len(data):
+        raise ValueError("RLP item is truncated")
+
+    prefix = data[position]
+
+    if prefix < 0x80:
+        return False, position, position + 1
+
+    is_list = prefix >= 0xc0
+    short_length = prefix - (0xc0 if is_list else 0x80)
+
+    if short_length < 56:
+        start = position + 1
+        end = start + short_length
+    else:
+        start = position + short_length - 54
+        if data[position + 1] == 0:
+            raise ValueError("Length of RLP item has leading zeros")
+
+        end = start + int.from_bytes(data[position + 1:start], 'big')
+
+    if end > len(data):
+        raise ValueError("RLP item is truncated")
+
+    return is_list, start, end
+
+
+class _BuiltinCodec:
+    """
+    Codec for the three shapes of the nodes: 2-item leaf or extension and 17-item branch.
+
+    Byte layouts are written and read directly. Inline (shorter than 32 bytes) references are RLP-encoded
+    nodes themselves, so they are spliced into the encoded parent as is and are sliced out of it on decoding,
+    without being decoded and encoded again.
+    """
+
+    def encode_leaf(self, encoded_path, data):
+        payload = _encode_string(encoded_path) + _encode_string(data)
+        return _encode_length(len(payload), 0xc0) + payload
+
+    def encode_extension(self, encoded_path, next_ref):
+        payload = _encode_string(encoded_path) + _encode_reference(next_ref)
+        return _encode_length(len(payload), 0xc0) + payload
+
+    def encode_branch(self, branches, data):
+        payload = b''.join([_encode_reference(ref) for ref in branches]) + _encode_string(data)
+        return _encode_length(len(payload), 0xc0) + payload
+
+    def decode(self, encoded_data):
+        """
+        Returns the items of the encoded node. Strings are returned as is, and nested lists (inline nodes)
+        are returned as their encodings.
+        """
+        bounds = self.decode_bounds(encoded_data)
+        return [encoded_data[bounds[idx]:bounds[idx + 1]] for idx in range(0, len(bounds), 2)]
+
+    def decode_bounds(self, encoded_data):
+        """
+        Scans the encoded node once and returns a flat tuple (start, end, start, end, ...) with bounds
+        of every item in the encoded data. Items themselves aren't copied.
+        """
+        is_list, position, end = _item_bounds(encoded_data, 0)
+        if not is_list or end != len(encoded_data):
+            raise ValueError("Encoded node must be a single RLP list")
+
+        bounds = []
+        append = bounds.append
+        while position < end:
+            prefix = encoded_data[position]
+
+            # Short strings and short lists are parsed inline, as every node consists of them in practice.
+            if prefix < 0x80:
+                item_start, item_end = position, position + 1
+            elif prefix <= 0xb7:
+                item_start = position + 1
+                item_end = item_start + prefix - 0x80
+            elif 0xc0 <= prefix <= 0xf7:
+                item_start = position
+                item_end = position + 1 + prefix - 0xc0
+            else:
+                is_list, start, item_end = _item_bounds(encoded_data, position)
+                item_start = position if is_list else start
+
+            append(item_start)
+            append(item_end)
+            position = item_end
+
+        if position != end:
+            raise ValueError("RLP list items exceed the list length")
+
+        return tuple(bounds)
+
+
+class _RlpCodec:
+    """ Codec that uses generic encoder and decoder of the `rlp` package. """
+
+    def __init__(self, rlp):
+        self._rlp = rlp
+
+    def encode_leaf(self, encoded_path, data):
+        return self._rlp.encode([encoded_path, data])
+
+    def encode_extension(self, encoded_path, next_ref):
+        return self._rlp.encode([encoded_path, self._prepare_reference_for_encoding(next_ref)])
+
+    def encode_branch(self, branches, data):
+        return self._rlp.encode([self._prepare_reference_for_encoding(ref) for ref in branches] + [data])
+
+    def decode(self, encoded_data):
+        try:
+            items = self._rlp.decode(encoded_data)
+        except self._rlp.DecodingError as e:
+            raise ValueError(str(e)) from e
+
+        if not isinstance(items, list):
+            raise ValueError("Encoded node must be a single RLP list")
+
+        return [self._prepare_reference_for_usage(item) for item in items]
+
+    def _prepare_reference_for_usage(self, ref):
+        """ Encodes reference into RLP if needed so stored references will appear as bytes. """
+        if isinstance(ref, list):
+            return self._rlp.encode(ref)
+
+        return ref
+
+    def _prepare_reference_for_encoding(self, ref):
+        """ Decodes RLP-encoded reference if needed so the full node will be encoded correctly. """
+        if 0 < len(ref) < 32:
+            return self._rlp.decode(ref)
+
+        return ref
+
+
+def _load_rlp():
+    import rlp
+    return _RlpCodec(rlp)
+
+
+# Specialized codec goes first: it doesn't infer sedes and doesn't re-encode inline nodes.
+register_backend('rlp', 'builtin', _BuiltinCodec)
+register_backend('rlp', 'rlp', _load_rlp)
+
+
+def _child_hashes(node):
+    """ Returns hashes of the nodes referenced by the given node. Inline nodes can't contain hashes. """
+    if type(node) is Node.Extension:
+        children = (node.next_ref,)
+    elif type(node) is Node.Branch:
+        children = node.branches
+    else:
+        children = ()
+
+    return [child for child in children if len(child) == 32]
+
+
 class Node:
-    EMPTY_HASH = keccak_hash(rlp.encode(b''))
+    # Hash of the RLP-encoded empty string. It's a constant, so hash and codec backends aren't loaded on import.
+    EMPTY_HASH = bytes.fromhex('56e81f171bcc55a6ff8345e692c0f86e5b48e01b996cadc001622fb5e363b421')
+
+    # Nodes are immutable: instead of changing a node, a new one is created. Unchanged children are shared
+    # between old and new nodes. It makes nodes safe to cache and to share between tries and threads.
 
     class Leaf:
+        __slots__ = ('_path', '_data', '_encoded')
+
         def __init__(self, path, data):
-            self.path = path
-            self.data = data
+            self._path = path
+            self._data = data
+            self._encoded = None
+
+        @property
+        def path(self):
+            return self._path
+
+        @property
+        def data(self):
+            return self._data
+
+        def with_data(self, data):
+            """ Returns a new leaf with the same path and provided data. """
+            return Node.Leaf(self._path, data)
 
         def encode(self):
-            return rlp.encode([self.path.encode(True), self.data])
+            """ Returns RLP-encoded node. Encoding is memoized in the node. """
+            if self._encoded is None:
+                self._encoded = self._encode()
+            return self._encoded
+
+        def _encode(self):
+            return get_backend('rlp').encode_leaf(self._path.encode(True), self._data)
 
     class Extension:
+        __slots__ = ('_path', '_next_ref', '_encoded')
+
         def __init__(self, path, next_ref):
-            self.path = path
-            self.next_ref = next_ref
+            self._path = path
+            self._next_ref = next_ref
+            self._encoded = None
+
+        @property
+        def path(self):
+            return self._path
+
+        @property
+        def next_ref(self):
+            return self._next_ref
+
+        def with_next_ref(self, next_ref):
+            """ Returns a new extension with the same path and provided reference to the next node. """
+            return Node.Extension(self._path, next_ref)
 
         def encode(self):
-            next_ref = _prepare_reference_for_encoding(self.next_ref)
-            return rlp.encode([self.path.encode(False), next_ref])
+            """ Returns RLP-encoded node. Encoding is memoized in the node. """
+            if self._encoded is None:
+                self._encoded = self._encode()
+            return self._encoded
+
+        def _encode(self):
+            return get_backend('rlp').encode_extension(self._path.encode(False), self._next_ref)
 
     class Branch:
+        __slots__ = ('_branches', '_data', '_encoded', '_bounds')
+
         def __init__(self, branches, data=None):
-            self.branches = branches
-            self.data = data
+            self._branches = tuple(branches)
+            self._data = data
+            self._encoded = None
+            # Bounds of the references in the encoded node if references aren't materialized yet.
+            self._bounds = None
+
+        def _from_encoded(encoded_data, bounds):
+            """
+            Creates a lazy branch over the encoded node. Only the data is sliced right away: references are
+            sliced from the encoded node on demand, using the bounds found by the codec in one scan.
+            """
+            node = Node.Branch.__new__(Node.Branch)
+            node._branches = None
+            node._data = encoded_data[bounds[32]:bounds[33]]
+            node._encoded = encoded_data
+            node._bounds = bounds
+            return node
+
+        @property
+        def branches(self):
+            if self._branches is None:
+                # Concurrent readers may materialize the references twice, but the result is the same.
+                encoded, bounds = self._encoded, self._bounds
+                self._branches = tuple(encoded[bounds[idx]:bounds[idx + 1]] for idx in range(0, 32, 2))
+            return self._branches
+
+        def branch(self, idx):
+            """ Returns a reference with the given index without materializing the other ones. """
+            branches = self._branches
+            if branches is not None:
+                return branches[idx]
+
+            bounds = self._bounds
+            return self._encoded[bounds[idx * 2]:bounds[idx * 2 + 1]]
+
+        @property
+        def data(self):
+            return self._data
+
+        def with_branch(self, idx, ref):
+            """ Returns a new branch where reference with given index is replaced. Other references are shared. """
+            branches = self.branches
+            return Node.Branch(branches[:idx] + (ref,) + branches[idx + 1:], self._data)
+
+        def with_data(self, data):
+            """ Returns a new branch with the same references and provided data. """
+            return Node.Branch(self.branches, data)
 
         def encode(self):
-            branches = list(map(_prepare_reference_for_encoding, self.branches))
-            return rlp.encode(branches + [self.data])
+            """ Returns RLP-encoded node. Encoding is memoized in the node. """
+            if self._encoded is None:
+                self._encoded = self._encode()
+            return self._encoded
+
+        def _encode(self):
+            return get_backend('rlp').encode_branch(self.branches, self._data)
 
     def decode(encoded_data):
-        """ Decodes node from RLP. """
-        data = rlp.decode(encoded_data)
+        """
+        Decodes node from RLP. Any bytes-like object (e.g. `memoryview`) may be decoded.
 
-        assert len(data) == 17 or len(data) == 2   # TODO throw exception
+        Raises
+        ------
+        ValueError
+            ValueError is raised if data isn't an encoded node.
+        """
+        encoded_data = bytes(encoded_data)
+        codec = get_backend('rlp')
+
+        # Codecs that can find bounds of the items allow to decode branches lazily.
+        decode_bounds = getattr(codec, 'decode_bounds', None)
+        if decode_bounds is not None:
+            bounds = decode_bounds(encoded_data)
+            if len(bounds) == 34:
+                return Node.Branch._from_encoded(encoded_data, bounds)
+
+            data = [encoded_data[bounds[idx]:bounds[idx + 1]] for idx in range(0, len(bounds), 2)]
+        else:
+            data = codec.decode(encoded_data)
 
         if len(data) == 17:
-            branches = list(map(_prepare_reference_for_usage, data[:16]))
-            node_data = data[16]
-            return Node.Branch(branches, node_data)
+            node = Node.Branch(data[:16], data[16])
+        elif len(data) == 2:
+            # Path is a non-empty string with a prefix nibble from 0 to 3, never an inline list.
+            if not data[0] or data[0][0] >= 0x40:
+                raise ValueError("Encoded node has invalid path")
 
-        path, is_leaf = NibblePath.decode_with_type(data[0])
-        if is_leaf:
-            return Node.Leaf(path, data[1])
+            path, is_leaf = NibblePath.decode_with_type(data[0])
+            if is_leaf:
+                node = Node.Leaf(path, data[1])
+            else:
+                node = Node.Extension(path, data[1])
         else:
-            ref = _prepare_reference_for_usage(data[1])
-            return Node.Extension(path, ref)
+            raise ValueError("Encoded node must have 2 or 17 items, got {}".format(len(data)))
+
+        # Node is already encoded, there is no need to encode it again. Views (e.g. into memory-mapped storage)
+        # are copied, so node doesn't hold the underlying memory.
+        node._encoded = encoded_data
+        return node
 
     def into_reference(node):
         """
@@ -0,0 +1,73 @@
+from .hash import keccak_hash, keccak_hash_many
+from .nibble_path import NibblePath
+from .node import Node
+
+
+def verify_proof(root_hash, encoded_key, proof, secure=False):
+    """
+    Checks the Merkle proof of the key against the root hash without any storage.
+
+    Proof is a list of RLP-encoded nodes as returned by `MerklePatriciaTrie.get_proof`.
+    Proofs for several keys generated by `MerklePatriciaTrie.get_proof_many` may be verified the same way.
+
+    Parameters
+    ----------
+    root_hash: bytes
+        Hash of the root node of the trie.
+    encoded_key: bytes
+        RLP-encoded key.
+    proof: list of bytes
+        RLP-encoded nodes of the proof.
+    secure: bool
+        (Optional) Whether the trie is in secure mode, i.e. keys are hashed using keccak256.
+
+    Returns
+    -------
+    bytes
+        Value associated with the key, or `None` if the proof shows that there is no such a key in the trie.
+
+    Raises
+    ------
+    ValueError
+        ValueError is raised if the proof doesn't match the root hash or lacks some of the nodes.
+    """
+    if root_hash == Node.EMPTY_HASH:
+        return None
+
+    nodes = dict(zip(keccak_hash_many(proof), proof))
+
+    if secure:
+        encoded_key = keccak_hash(encoded_key)
+
+    path = NibblePath(encoded_key)
+    node_ref = root_hash
+
+    while True:
+        if len(node_ref) == 32:
+            if node_ref not in nodes:
+                raise ValueError("Proof doesn't contain node with hash {}".format(node_ref.hex()))
+            raw_node = nodes[node_ref]
+        else:
+            raw_node = node_ref
+
+        node = Node.decode(raw_node)
+
+        if type(node) is Node.Leaf:
+            return node.data if node.path == path else None
+
+        elif type(node) is Node.Extension:
+            if not path.starts_with(node.path):
+                return None
+
+            node_ref = node.next_ref
+            path = path[len(node.path):]
+
+        elif type(node) is Node.Branch:
+            if len(path) == 0:
+                return node.data or None
+
+            node_ref = node.branch(path.at(0))
+            if not node_ref:
+                return None
+
+            path = path[1:]
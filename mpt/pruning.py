@@ -0,0 +1,108 @@
+from collections import deque
+from .node import Node, _child_hashes
+
+
+class RefCountPruner:
+    def __init__(self, storage, keep_roots=128, refcounts=None):
+        """
+        Creates a new pruner that removes stale nodes from the storage using reference counting.
+
+        Every node written to the storage counts references from its parents and from the retained roots.
+        Pruner keeps last `keep_roots` roots of the trie (one root per commit, i.e. per `update`, `delete`
+        or batch). When a root is released, nodes that aren't reachable from any retained root anymore
+        are removed from the storage.
+
+        Note: reference counts are correct only if all the nodes in the storage were written through
+        the tries using this pruner (or pruners sharing the same `refcounts`). Nodes written without pruning
+        are never removed.
+
+        Parameters
+        ----------
+        storage: dict-like
+            Storage of the trie. It must implement `__delitem__` in addition to `__getitem__` and `__setitem__`.
+        keep_roots: int
+            (Optional) Amount of the latest roots which nodes must be kept in the storage.
+        refcounts: dict-like
+            (Optional) Storage for reference counts. It may be persistent to keep counts between restarts.
+
+        Returns
+        -------
+        RefCountPruner
+            An instance of the pruner.
+        """
+        if keep_roots < 1:
+            raise ValueError("At least one root must be kept")
+
+        self._storage = storage
+        self._keep_roots = keep_roots
+        self._refcounts = refcounts if refcounts is not None else {}
+        self._roots = deque()
+        # Nodes written since the last commit.
+        self._new_nodes = []
+
+    def refcount(self, node_hash):
+        """ Returns the amount of references to the node. """
+        return self._refcounts.get(node_hash, 0)
+
+    def retained_roots(self):
+        """ Returns the list of the retained roots, from the oldest to the latest. """
+        return list(self._roots)
+
+    def node_written(self, node_hash, node):
+        """ Registers the node written to the storage by the trie. """
+        if node_hash in self._refcounts:
+            # Node is already stored, it holds references to its children.
+            return
+
+        self._refcounts[node_hash] = 0
+        for child_hash in _child_hashes(node):
+            self._refcounts[child_hash] = self._refcounts.get(child_hash, 0) + 1
+
+        self._new_nodes.append(node_hash)
+
+    def commit(self, root):
+        """
+        Retains the new root of the trie and releases the roots that don't fit into the window.
+        Nodes written since the last commit that turned out to be unused are removed as well.
+        """
+        if root is not None and len(root) == 32:
+            self._refcounts[root] = self._refcounts.get(root, 0) + 1
+        self._roots.append(root)
+
+        while len(self._roots) > self._keep_roots:
+            old_root = self._roots.popleft()
+            if old_root is not None and len(old_root) == 32:
+                self._release(old_root)
+
+        # Some nodes are written only to be merged into other nodes right away.
+        new_nodes, self._new_nodes = self._new_nodes, []
+        for node_hash in new_nodes:
+            if self._refcounts.get(node_hash) == 0:
+                self._remove(node_hash)
+
+    def _release(self, node_hash):
+        """ Removes one reference to the node. """
+        self._refcounts[node_hash] -= 1
+        if self._refcounts[node_hash] == 0:
+            self._remove(node_hash)
+
+    def _remove(self, node_hash):
+        """ Removes the unreferenced node from the storage with all the nodes referenced only by it. """
+        pending = [node_hash]
+
+        while pending:
+            node_hash = pending.pop()
+
+            raw_node = self._storage[node_hash]
+            del self._storage[node_hash]
+            del self._refcounts[node_hash]
+
+            for child_hash in _child_hashes(Node.decode(raw_node)):
+                count = self._refcounts.get(child_hash)
+                if count is None:
+                    # Node wasn't written through the pruner, so it's never removed.
+                    continue
+
+                self._refcounts[child_hash] = count - 1
+                if count == 1:
+                    pending.append(child_hash)
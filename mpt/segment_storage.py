@@ -0,0 +1,372 @@
+import mmap
+import os
+import struct
+from itertools import islice
+from .storage import Storage
+
+# Record header: type of the record, key and length of the value.
+_HEADER = struct.Struct('>B32sI')
+# Record types. Zero byte means the end of written data in the segment.
+_END = 0
+_PUT = 1
+_DELETE = 2
+_COMMIT = 3
+
+# Header of the index file: segment and offset up to which index is valid, and amount of entries.
+_INDEX_HEADER = struct.Struct('>IQQ')
+# Header is followed by the fanout table: for each 2-byte key prefix, position of the first entry with it.
+# Hashes are uniformly distributed, so the table narrows the binary search down to a few entries.
+_FANOUT = struct.Struct('>65537I')
+_FANOUT_RANGE = struct.Struct('>II')
+# Fanout table is followed by the entries sorted by key.
+_INDEX_ENTRY = struct.Struct('>32sQ')
+_LOCATION = struct.Struct('>Q')
+_ENTRIES_START = _INDEX_HEADER.size + _FANOUT.size
+# Amount of index entries written at once when the index is saved.
+_INDEX_CHUNK = 65536
+
+# Location of the record in the index is (segment << _SEGMENT_SHIFT) | offset.
+_SEGMENT_SHIFT = 40
+_OFFSET_MASK = (1 << _SEGMENT_SHIFT) - 1
+
+# Marker of the keys that aren't changed since the index was saved.
+_MISSING = object()
+
+
+class SegmentStorage(Storage):
+    def __init__(self, path, segment_size=64 * 1024 * 1024):
+        """
+        Creates a persistent storage of nodes in the append-only memory-mapped segment files.
+
+        Every change is appended to the last segment, and the index maps 32-byte keys (node hashes)
+        to the locations of the values. Values are returned as zero-copy `memoryview` objects pointing right
+        into the mapped segments. They are valid until the storage is closed.
+
+        Changes become durable after `commit`, which writes a commit marker and flushes the segments to the disk.
+        On opening, changes written after the last commit marker (e.g. because of a crash) are thrown away.
+
+        On `close` the index is saved as a sorted array of packed (key, location) entries, 40 bytes per key.
+        On opening that file is memory-mapped rather than loaded, and keys are found by binary search in it,
+        so opening doesn't depend on the amount of nodes and the index doesn't live in the Python heap.
+        Hashes are uniformly distributed, so a table of 2-byte prefixes narrows the search down to a few entries.
+        Only the keys changed since the index was saved are kept in a dict. Note that if the index file
+        is lost, all the segments are scanned on opening, and the whole index is kept in the dict until `close`.
+
+        Removed values still occupy space in the segments. To reclaim it, copy the live nodes to a new storage
+        with `mpt.compact`.
+
+        Parameters
+        ----------
+        path: str
+            Directory with the segment files. It's created if doesn't exist.
+        segment_size: int
+            (Optional) Size of one segment file in bytes.
+
+        Returns
+        -------
+        SegmentStorage
+            An instance of the storage.
+        """
+        os.makedirs(path, exist_ok=True)
+
+        self._path = path
+        self._segment_size = segment_size
+        # Saved index: memory-mapped index file and amount of entries in it.
+        self._base = None
+        self._base_count = 0
+        # Keys changed since the index was saved. `None` location means that the key is deleted.
+        self._index = {}
+        self._segments = []
+        # Position in the last segment where the next record will be written.
+        self._position = 0
+        self._dirty = False
+
+        self._open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getitem__(self, key):
+        location = self._locate(key)
+        if location is None:
+            raise KeyError(key)
+
+        segment = self._segments[location >> _SEGMENT_SHIFT]
+        offset = location & _OFFSET_MASK
+
+        _, _, length = _HEADER.unpack_from(segment, offset)
+        start = offset + _HEADER.size
+        return memoryview(segment)[start:start + length]
+
+    def __setitem__(self, key, value):
+        if len(key) != 32:
+            raise ValueError("Keys must be 32 bytes long, got {}".format(len(key)))
+
+        location = self._append(_PUT, key, value)
+        self._index[key] = location
+
+    def __delitem__(self, key):
+        if self._locate(key) is None:
+            raise KeyError(key)
+
+        self._append(_DELETE, key, b'')
+        self._index[key] = None
+
+    def __contains__(self, key):
+        return self._locate(key) is not None
+
+    def __len__(self):
+        count = self._base_count
+        for key, location in self._index.items():
+            count += (location is not None) - (self._find_saved(key) is not None)
+        return count
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def commit(self):
+        """ Makes all the changes durable. """
+        if not self._dirty:
+            return
+
+        # Data must reach the disk before the commit marker, so marker never points to the lost data.
+        self._flush()
+        self._append(_COMMIT, bytes(32), b'')
+        self._flush()
+        self._dirty = False
+
+    def close(self):
+        """ Commits the changes, saves the index and closes the segments. """
+        if not self._segments:
+            return
+
+        self.commit()
+        self._save_index()
+
+        if self._base is not None:
+            self._base.close()
+            self._base = None
+
+        for segment in self._segments:
+            try:
+                segment.close()
+            except BufferError:
+                # Some values are still used. Segment will be closed when they are released.
+                pass
+
+        self._segments = []
+
+    def _locate(self, key):
+        """ Returns the location of the value or `None` if there is no such a key. """
+        location = self._index.get(key, _MISSING)
+        if location is _MISSING:
+            return self._find_saved(key)
+        return location
+
+    def _find_saved(self, key):
+        """ Finds the location of the key in the saved index with binary search. """
+        base = self._base
+        if base is None or len(key) != 32:
+            return None
+
+        entry_size = _INDEX_ENTRY.size
+        low, high = _FANOUT_RANGE.unpack_from(base, _INDEX_HEADER.size + ((key[0] << 8) | key[1]) * 4)
+
+        while low < high:
+            middle = (low + high) >> 1
+            start = _ENTRIES_START + middle * entry_size
+            probe = base[start:start + 32]
+            if probe < key:
+                low = middle + 1
+            elif probe > key:
+                high = middle
+            else:
+                return _LOCATION.unpack_from(base, start + 32)[0]
+
+        return None
+
+    def _segment_path(self, number):
+        return os.path.join(self._path, 'segment-{:06d}.dat'.format(number))
+
+    def _index_path(self):
+        return os.path.join(self._path, 'index.dat')
+
+    def _map_segment(self, number, size=None):
+        """ Maps the segment file into memory, creating it with the provided size if needed. """
+        with open(self._segment_path(number), 'a+b') as segment_file:
+            if size is not None:
+                segment_file.truncate(size)
+            return mmap.mmap(segment_file.fileno(), 0)
+
+    def _open(self):
+        """ Maps the segments, loads the index and replays the changes that are not in the index. """
+        segment_count = 0
+        while os.path.exists(self._segment_path(segment_count)):
+            segment_count += 1
+
+        if segment_count == 0:
+            self._segments.append(self._map_segment(0, self._segment_size))
+            return
+
+        self._segments = [self._map_segment(number) for number in range(segment_count)]
+
+        segment_number, offset = self._load_index()
+        self._recover(segment_number, offset)
+
+    def _load_index(self):
+        """ Loads the saved index. Returns the position up to which the index is valid. """
+        if not os.path.exists(self._index_path()):
+            return 0, 0
+
+        with open(self._index_path(), 'rb') as index_file:
+            header = index_file.read(_INDEX_HEADER.size)
+            if len(header) < _INDEX_HEADER.size:
+                return 0, 0
+
+            segment_number, offset, count = _INDEX_HEADER.unpack(header)
+            entries_size = count * _INDEX_ENTRY.size
+            if segment_number >= len(self._segments) or \
+                    os.fstat(index_file.fileno()).st_size != _ENTRIES_START + entries_size:
+                return 0, 0
+
+            if count:
+                self._base = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._base_count = count
+
+        return segment_number, offset
+
+    def _save_index(self):
+        """ Saves the index of committed data, so it's not needed to scan the segments on the next opening. """
+        tmp_path = self._index_path() + '.tmp'
+
+        count = 0
+        # Amount of entries with each 2-byte prefix, shifted by one to turn into positions afterwards.
+        fanout = [0] * 65537
+
+        with open(tmp_path, 'wb') as index_file:
+            # Header and fanout table are written when the entries are counted.
+            index_file.write(bytes(_ENTRIES_START))
+
+            entries = self._merged_entries()
+            while True:
+                chunk = list(islice(entries, _INDEX_CHUNK))
+                if not chunk:
+                    break
+
+                for key, _ in chunk:
+                    fanout[((key[0] << 8) | key[1]) + 1] += 1
+                index_file.write(b''.join([_INDEX_ENTRY.pack(key, location) for key, location in chunk]))
+                count += len(chunk)
+
+            for prefix in range(1, len(fanout)):
+                fanout[prefix] += fanout[prefix - 1]
+
+            index_file.seek(0)
+            index_file.write(_INDEX_HEADER.pack(len(self._segments) - 1, self._position, count))
+            index_file.write(_FANOUT.pack(*fanout))
+
+        os.replace(tmp_path, self._index_path())
+
+    def _merged_entries(self):
+        """ Yields (key, location) of all the stored keys sorted by key, merging saved index with the changes. """
+        changes = sorted(self._index.items())
+        change_idx = 0
+
+        for idx in range(self._base_count):
+            key, location = _INDEX_ENTRY.unpack_from(self._base, _ENTRIES_START + idx * _INDEX_ENTRY.size)
+
+            while change_idx < len(changes) and changes[change_idx][0] <= key:
+                changed_key, changed_location = changes[change_idx]
+                change_idx += 1
+                if changed_location is not None:
+                    yield changed_key, changed_location
+                if changed_key == key:
+                    # Saved location is replaced by the change.
+                    break
+            else:
+                yield key, location
+
+        for changed_key, changed_location in changes[change_idx:]:
+            if changed_location is not None:
+                yield changed_key, changed_location
+
+    def _recover(self, segment_number, offset):
+        """ Replays the records starting from the provided position. Changes after the last commit are dropped. """
+        committed_position = (segment_number, offset)
+        # Previous locations of the keys changed after the last commit, to roll the changes back.
+        journal = []
+
+        for number in range(segment_number, len(self._segments)):
+            segment = self._segments[number]
+
+            while offset + _HEADER.size <= len(segment):
+                record_type, key, length = _HEADER.unpack_from(segment, offset)
+                record_end = offset + _HEADER.size + length
+
+                if record_type == _END or record_end > len(segment):
+                    break
+
+                if record_type == _PUT:
+                    journal.append((key, self._index.get(key, _MISSING)))
+                    self._index[key] = (number << _SEGMENT_SHIFT) | offset
+                elif record_type == _DELETE:
+                    journal.append((key, self._index.get(key, _MISSING)))
+                    self._index[key] = None
+                elif record_type == _COMMIT:
+                    journal.clear()
+                    committed_position = (number, record_end)
+                else:
+                    # Garbage after the crash.
+                    break
+
+                offset = record_end
+
+            offset = 0
+
+        for key, location in reversed(journal):
+            if location is _MISSING:
+                del self._index[key]
+            else:
+                self._index[key] = location
+
+        last_segment, self._position = committed_position
+
+        # Drop everything written after the last commit.
+        for number in range(len(self._segments) - 1, last_segment, -1):
+            self._segments.pop().close()
+            os.remove(self._segment_path(number))
+
+        # Records are contiguous, so if there is no record right after the commit, there is nothing to drop.
+        segment = self._segments[last_segment]
+        if self._position < len(segment) and segment[self._position] != _END:
+            segment[self._position:] = bytes(len(segment) - self._position)
+            segment.flush()
+
+    def _append(self, record_type, key, value):
+        """ Appends the record to the last segment. Returns the location of the record. """
+        record_size = _HEADER.size + len(value)
+        segment = self._segments[-1]
+
+        # Leave room for the end marker, so the end of the data is always recognized.
+        if self._position + record_size + 1 > len(segment):
+            self._flush()
+            size = max(self._segment_size, record_size + 1)
+            segment = self._map_segment(len(self._segments), size)
+            self._segments.append(segment)
+            self._position = 0
+
+        offset = self._position
+        _HEADER.pack_into(segment, offset, record_type, key, len(value))
+        segment[offset + _HEADER.size:offset + record_size] = value
+
+        self._position += record_size
+        self._dirty = True
+
+        return ((len(self._segments) - 1) << _SEGMENT_SHIFT) | offset
+
+    def _flush(self):
+        """ Flushes the last segment to the disk. Previous segments are flushed when new segment is created. """
+        self._segments[-1].flush()
@@ -0,0 +1,114 @@
+import sqlite3
+import threading
+from .storage import Storage
+
+
+class SqliteStorage(Storage):
+    # Amount of keys in one `SELECT ... IN` query. Shorter chunks are padded, so the same prepared
+    # statement is reused for all the queries.
+    _SELECT_CHUNK = 256
+
+    def __init__(self, path, table='nodes'):
+        """
+        Creates a persistent storage of nodes in the SQLite database.
+
+        Nodes are stored in a `WITHOUT ROWID` table keyed by hash. Bulk writes (`put_many`, used by the trie
+        to store all the nodes of a batch) are made in a single transaction with `executemany`, and bulk reads
+        (`get_many`) use multi-key `SELECT ... IN` queries. Single writes are committed on `commit`,
+        on the next bulk write or on `close`.
+
+        Storage may be passed to other processes: it's pickled as the path, and the database is reopened there.
+
+        Parameters
+        ----------
+        path: str
+            Path to the database file.
+        table: str
+            (Optional) Name of the table with nodes.
+
+        Returns
+        -------
+        SqliteStorage
+            An instance of the storage.
+        """
+        self._path = path
+        self._table = table
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS {} (hash BLOB PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID'.format(table))
+        self._connection.commit()
+
+        self._get_query = 'SELECT value FROM {} WHERE hash = ?'.format(table)
+        self._put_query = 'INSERT OR REPLACE INTO {} (hash, value) VALUES (?, ?)'.format(table)
+        self._delete_query = 'DELETE FROM {} WHERE hash = ?'.format(table)
+        self._select_many_query = 'SELECT hash, value FROM {} WHERE hash IN ({})'.format(
+            table, ', '.join(['?'] * SqliteStorage._SELECT_CHUNK))
+
+    def __reduce__(self):
+        return SqliteStorage, (self._path, self._table)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getitem__(self, key):
+        with self._lock:
+            row = self._connection.execute(self._get_query, (key,)).fetchone()
+
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._connection.execute(self._put_query, (key, value))
+
+    def __delitem__(self, key):
+        with self._lock:
+            cursor = self._connection.execute(self._delete_query, (key,))
+
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._connection.execute(self._get_query, (key,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM {}'.format(self._table)).fetchone()[0]
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+        chunk_size = SqliteStorage._SELECT_CHUNK
+
+        with self._lock:
+            for start in range(0, len(keys), chunk_size):
+                chunk = keys[start:start + chunk_size]
+                chunk += [chunk[-1]] * (chunk_size - len(chunk))
+                found.update(self._connection.execute(self._select_many_query, chunk))
+
+        return [found.get(key) for key in keys]
+
+    def put_many(self, items):
+        with self._lock, self._connection:
+            self._connection.executemany(self._put_query, items)
+
+    def delete_many(self, keys):
+        with self._lock, self._connection:
+            self._connection.executemany(self._delete_query, ((key,) for key in keys))
+
+    def commit(self):
+        """ Commits all the single writes. """
+        with self._lock:
+            self._connection.commit()
+
+    def close(self):
+        """ Commits the changes and closes the database. """
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
@@ -0,0 +1,235 @@
+import dbm
+
+
+class Storage:
+    """
+    Interface of the node storage used by MerklePatriciaTrie.
+
+    Trie only requires `__getitem__` and `__setitem__`, so any dict-like object can be used as a storage.
+    Storages that can read or write many nodes at once (e.g. with one round trip to the database) should
+    also implement `get_many`, `put_many` and `delete_many`: trie uses them automatically when they exist.
+    Default implementations of bulk methods just process keys one by one.
+    """
+
+    def __getitem__(self, key):
+        raise NotImplementedError
+
+    def __setitem__(self, key, value):
+        raise NotImplementedError
+
+    def __delitem__(self, key):
+        raise NotImplementedError
+
+    def __contains__(self, key):
+        raise NotImplementedError
+
+    def get(self, key, default=None):
+        """ Returns the value for the key or `default` if there is no such a key. """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_many(self, keys):
+        """ Returns a list of values for provided keys. `None` is returned for keys that are not stored. """
+        return [self.get(key) for key in keys]
+
+    def put_many(self, items):
+        """ Stores all the provided (key, value) pairs. """
+        for key, value in items:
+            self[key] = value
+
+    def delete_many(self, keys):
+        """ Removes all the provided keys. Keys that are not stored are ignored. """
+        for key in keys:
+            if key in self:
+                del self[key]
+
+
+class DictStorage(Storage):
+    def __init__(self, data=None):
+        """ Creates an in-memory storage over the dict. If `data` isn't provided, a new dict is created. """
+        self._data = data if data is not None else {}
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_many(self, keys):
+        data = self._data
+        return [data.get(key) for key in keys]
+
+    def put_many(self, items):
+        self._data.update(items)
+
+
+class DbmStorage(Storage):
+    def __init__(self, path, flag='c'):
+        """
+        Creates an on-disk storage over the database from the standard `dbm` module.
+
+        Parameters
+        ----------
+        path: str
+            Path to the database file.
+        flag: str
+            (Optional) Mode of opening the database, as in `dbm.open`. By default database is created if needed.
+        """
+        self._db = dbm.open(path, flag)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getitem__(self, key):
+        return self._db[key]
+
+    def __setitem__(self, key, value):
+        self._db[key] = value
+
+    def __delitem__(self, key):
+        del self._db[key]
+
+    def __contains__(self, key):
+        return key in self._db
+
+    def __len__(self):
+        return len(self._db)
+
+    def sync(self):
+        """ Writes all the cached data to the disk if the database supports it. """
+        sync = getattr(self._db, 'sync', None)
+        if sync is not None:
+            sync()
+
+    def close(self):
+        """ Closes the database. """
+        self._db.close()
+
+
+class WriteBuffer(Storage):
+    def __init__(self, backend):
+        """
+        Creates a storage that keeps all the changes in memory until they are flushed to the backend.
+
+        Repeated writes of the same key are coalesced, and all the buffered changes are written
+        with a single `put_many` (and `delete_many`) call on `flush`. Reads see the buffered changes.
+        Buffered changes may also be thrown away with `discard`. Trie working over the buffer flushes it
+        on every commit: after each update or delete, and on exit from the outermost batch.
+
+        Parameters
+        ----------
+        backend: dict-like
+            Storage to flush the changes to.
+        """
+        self._backend = backend
+        # Buffered changes. `None` value means that the key is deleted.
+        self._pending = {}
+
+    def __getitem__(self, key):
+        value = self._pending.get(key, self)
+        if value is self:
+            return self._backend[key]
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._pending[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._pending[key] = None
+
+    def __contains__(self, key):
+        value = self._pending.get(key, self)
+        if value is self:
+            return key in self._backend
+        return value is not None
+
+    def backend(self):
+        """ Returns the storage the changes are flushed to. """
+        return self._backend
+
+    def pending(self):
+        """ Returns the amount of buffered changes. """
+        return len(self._pending)
+
+    def changes(self):
+        """ Returns an iterator over buffered (key, value) changes. Value is `None` for deleted keys. """
+        return iter(self._pending.items())
+
+    def get_many(self, keys):
+        values = []
+        missing_keys = []
+        missing_idxs = []
+
+        for idx, key in enumerate(keys):
+            value = self._pending.get(key, self)
+            if value is self:
+                missing_keys.append(key)
+                missing_idxs.append(idx)
+            values.append(value)
+
+        if missing_keys:
+            get_many = getattr(self._backend, 'get_many', None)
+            if get_many is not None:
+                backend_values = get_many(missing_keys)
+            else:
+                backend_values = [self._backend.get(key) for key in missing_keys]
+
+            for idx, value in zip(missing_idxs, backend_values):
+                values[idx] = value
+
+        return values
+
+    def put_many(self, items):
+        self._pending.update(items)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self._pending[key] = None
+
+    def flush(self):
+        """ Writes all the buffered changes to the backend. """
+        if not self._pending:
+            return
+
+        puts = [(key, value) for key, value in self._pending.items() if value is not None]
+        deletes = [key for key, value in self._pending.items() if value is None]
+
+        put_many = getattr(self._backend, 'put_many', None)
+        if put_many is not None:
+            put_many(puts)
+        else:
+            for key, value in puts:
+                self._backend[key] = value
+
+        delete_many = getattr(self._backend, 'delete_many', None)
+        if delete_many is not None:
+            delete_many(deletes)
+        else:
+            for key in deletes:
+                if key in self._backend:
+                    del self._backend[key]
+
+        # Changes are dropped only after they are written, so concurrent readers always see them.
+        self._pending = {}
+
+    def discard(self):
+        """ Throws away all the buffered changes. """
+        self._pending = {}
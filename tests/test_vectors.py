@@ -1,8 +1,9 @@
 import unittest
-from mpt import MerklePatriciaTrie
+from mpt import MerklePatriciaTrie, backends
 from mpt.hash import keccak_hash
 import os
 import json
+import rlp
 
 CURRENT_FOLDER = os.path.dirname(os.path.realpath(__file__))
 BASE_FOLDER = os.path.join(CURRENT_FOLDER, 'test_vectors')
@@ -36,18 +37,44 @@ class TestVectors(unittest.TestCase):
                 trie = MerklePatriciaTrie(storage, secure=secure)
 
                 data_samples = input_data if isinstance(input_data, list) else input_data.items()
+                final_state = {}
 
                 for k, v in data_samples:
                     k, v = normalize_kv(k, v)
 
                     if v:
                         trie.update(k, v)
+                        final_state[k] = v
                     else:
                         trie.delete(k)
+                        final_state.pop(k, None)
 
                 expected_root = normalize_value(data[test]['root'])
                 self.assertEqual(trie.root_hash(), expected_root, msg='Test {} failed'.format(test))
 
+                # Nodes written by the built-in codec are exactly the ones written with the `rlp` package.
+                rlp_storage = {}
+                backends.use_backend('rlp', 'rlp')
+                try:
+                    rlp_trie = MerklePatriciaTrie(rlp_storage, secure=secure)
+                    for k, v in data_samples:
+                        k, v = normalize_kv(k, v)
+                        if v:
+                            rlp_trie.update(k, v)
+                        else:
+                            rlp_trie.delete(k)
+                finally:
+                    backends.use_backend('rlp', 'builtin')
+
+                self.assertEqual(storage, rlp_storage, msg='Test {} failed (rlp codec)'.format(test))
+                for raw_node in storage.values():
+                    self.assertEqual(rlp.encode(rlp.decode(raw_node)), raw_node)
+
+                sort_key = (lambda kv: keccak_hash(kv[0])) if secure else (lambda kv: kv[0])
+                sorted_items = sorted(final_state.items(), key=sort_key)
+                built_trie = MerklePatriciaTrie.from_sorted_items({}, iter(sorted_items), secure=secure)
+                self.assertEqual(built_trie.root_hash(), expected_root, msg='Test {} failed (sorted build)'.format(test))
+
     def test_hex_encoded_securetrie_test(self):
         test_vector_name = 'hex_encoded_securetrie_test.json'
         secure = True
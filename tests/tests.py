@@ -1,9 +1,20 @@
+import os
 import unittest
-from mpt import MerklePatriciaTrie
+from mpt import MerklePatriciaTrie, NodeCache, RefCountPruner, compact, diff, verify_proof
 from mpt.nibble_path import NibblePath
 from mpt.node import Node
+from mpt.hash import keccak_hash, keccak_hash_many
+from mpt import backends
+from mpt.storage import DbmStorage, DictStorage, WriteBuffer
+from mpt.segment_storage import SegmentStorage
+from mpt.sqlite_storage import SqliteStorage
 import rlp
+import pickle
 import random
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from unittest import mock
 
 
 class TestNibblePath(unittest.TestCase):
@@ -52,6 +63,52 @@ class TestNibblePath(unittest.TestCase):
         common = nibbles_a.common_prefix(nibbles_b)
         self.assertEqual(common, NibblePath([]))
 
+    def test_slice(self):
+        nibbles = NibblePath([0x12, 0x34, 0x56])
+        tail = nibbles[1:]
+        middle = nibbles[2:5]
+
+        self.assertEqual(tail, NibblePath([0x23, 0x45, 0x60], length=5))
+        self.assertEqual(middle, NibblePath([0x34, 0x50], length=3))
+        self.assertEqual(middle[0], 0x3)
+        self.assertEqual(middle[-1], 0x5)
+        self.assertEqual(len(nibbles[10:]), 0)
+        with self.assertRaises(IndexError):
+            middle[3]
+
+        # Original path is not affected.
+        self.assertEqual(len(nibbles), 6)
+        self.assertEqual(nibbles[0], 0x1)
+        self.assertEqual(hash(tail), hash(NibblePath([0x02, 0x34, 0x56], offset=1)))
+
+    def test_starts_with(self):
+        nibbles = NibblePath([0x12, 0x34, 0x56], offset=1)
+        self.assertTrue(nibbles.starts_with(NibblePath([0x23])))
+        self.assertTrue(nibbles.starts_with(NibblePath([0x02, 0x34], offset=1)))
+        self.assertTrue(nibbles.starts_with(NibblePath([])))
+        self.assertFalse(nibbles.starts_with(NibblePath([0x24])))
+        self.assertFalse(nibbles.starts_with(NibblePath([0x23, 0x45, 0x67])))
+
+    def test_unaligned_paths(self):
+        random.seed(42)
+        for _ in range(200):
+            data = bytes(random.randint(0, 255) for _ in range(8))
+            offset_a = random.randint(0, 8)
+            offset_b = random.randint(0, 8)
+            nibbles_a = NibblePath(data, offset_a)
+            nibbles_b = NibblePath(data, offset_b)
+
+            a = [nibbles_a.at(i) for i in range(len(nibbles_a))]
+            b = [nibbles_b.at(i) for i in range(len(nibbles_b))]
+
+            common_len = 0
+            while common_len < min(len(a), len(b)) and a[common_len] == b[common_len]:
+                common_len += 1
+
+            self.assertEqual(nibbles_a == nibbles_b, a == b)
+            self.assertEqual(nibbles_a.starts_with(nibbles_b), a[:len(b)] == b)
+            self.assertEqual(len(nibbles_a.common_prefix(nibbles_b)), common_len)
+
     def test_combine(self):
         nibbles_a = NibblePath([0x12, 0x34])
         nibbles_b = NibblePath([0x56, 0x78])
@@ -72,6 +129,112 @@ class TestNode(unittest.TestCase):
         self.assertEqual(type(decoded), expected_type)
         self.assertEqual(raw_node, encoded)
 
+    def test_encoding_memoized(self):
+        leaf = Node.Leaf(NibblePath([0x12, 0x34]), b'data')
+        encoded = leaf.encode()
+        self.assertIs(leaf.encode(), encoded)
+
+        new_leaf = leaf.with_data(b'other_data')
+        self.assertEqual(new_leaf.encode(), rlp.encode([b'\x20\x12\x34', b'other_data']))
+        self.assertIs(leaf.encode(), encoded)
+
+        branch = Node.decode(rlp.encode([b''] * 16 + [b'value']))
+        with mock.patch.object(Node.Branch, '_encode') as encode:
+            branch.encode()
+            encode.assert_not_called()
+
+    def test_encode_count_per_update(self):
+        """ Every stored node must be encoded exactly once. """
+        random.seed(42)
+        keys = [bytes('{}'.format(random.randint(1, 1000000)), 'utf-8') for _ in range(200)]
+
+        encode_calls = []
+        original_encodes = {cls: cls._encode for cls in (Node.Leaf, Node.Extension, Node.Branch)}
+
+        def counting(cls):
+            def _encode(node):
+                encode_calls.append(cls)
+                return original_encodes[cls](node)
+            return _encode
+
+        trie = MerklePatriciaTrie({})
+        stored_nodes = []
+        original_write_node = MerklePatriciaTrie._write_node
+
+        def write_node(self, node):
+            stored_nodes.append(node)
+            return original_write_node(self, node)
+
+        with mock.patch.object(MerklePatriciaTrie, '_write_node', write_node), \
+                mock.patch.object(Node.Leaf, '_encode', counting(Node.Leaf)), \
+                mock.patch.object(Node.Extension, '_encode', counting(Node.Extension)), \
+                mock.patch.object(Node.Branch, '_encode', counting(Node.Branch)):
+            for kv in keys:
+                trie.update(kv, kv * 2)
+
+        self.assertEqual(len(encode_calls), len(stored_nodes))
+
+    def test_immutable(self):
+        leaf = Node.Leaf(NibblePath([0x12, 0x34]), b'data')
+        with self.assertRaises(AttributeError):
+            leaf.data = b'other_data'
+        with self.assertRaises(AttributeError):
+            leaf.some_field = 1
+
+        children = [rlp.encode([b'\x20', bytes([i])]) for i in range(16)]
+        branch = Node.Branch(children, b'value')
+        new_branch = branch.with_branch(3, b'')
+
+        self.assertEqual(branch.branches[3], children[3])
+        self.assertEqual(new_branch.branches[3], b'')
+        self.assertIs(new_branch.branches[4], branch.branches[4])
+        self.assertEqual(new_branch.data, b'value')
+
+    def test_lazy_branch(self):
+        inline_leaf = rlp.encode([b'\x35', b'x'])
+        children = [keccak_hash(bytes([i])) for i in range(14)] + [b'', inline_leaf]
+        raw_node = rlp.encode(children[:15] + [rlp.decode(inline_leaf), b'value'])
+
+        branch = Node.decode(memoryview(raw_node))
+        self.assertEqual(branch.data, b'value')
+        self.assertEqual([branch.branch(idx) for idx in range(16)], children)
+        # References are not materialized until all of them are requested.
+        self.assertIsNone(branch._branches)
+
+        self.assertEqual(branch.branches, tuple(children))
+        self.assertEqual(branch.branch(3), children[3])
+        self.assertEqual(branch.with_branch(3, b'').branches[3], b'')
+        self.assertEqual(branch.encode(), raw_node)
+
+        storage = {}
+        trie = MerklePatriciaTrie(storage)
+        trie.apply_batch((bytes([i, j]), bytes([i, j]) * 20) for i in range(16) for j in range(16))
+        root = trie.root()
+
+        lookups = []
+        original_from_encoded = Node.Branch._from_encoded
+
+        def from_encoded(encoded_data, bounds):
+            node = original_from_encoded(encoded_data, bounds)
+            lookups.append(node)
+            return node
+
+        with mock.patch.object(Node.Branch, '_from_encoded', from_encoded):
+            self.assertEqual(MerklePatriciaTrie(storage, root).get(b'\x01\x02'), b'\x01\x02' * 20)
+
+        # Get only needs one reference of every branch on the way.
+        self.assertEqual(len(lookups), 2)
+        self.assertTrue(all(node._branches is None for node in lookups))
+
+    def test_pickle(self):
+        leaf = Node.Leaf(NibblePath([0x12, 0x34])[1:], b'data')
+        branch = Node.Branch([leaf] + [b''] * 15, b'value')
+
+        restored = pickle.loads(pickle.dumps(branch))
+        self.assertEqual(restored.data, b'value')
+        self.assertEqual(restored.branches[0].path, leaf.path)
+        self.assertEqual(restored.branches[0].encode(), leaf.encode())
+
     def test_leaf(self):
         # Path 0xABC. 0x3_ at the beginning: 0x20 (for leaf type) + 0x10 (for odd len)
         nibbles_path = bytearray([0x3A, 0xBC])
@@ -80,6 +243,635 @@ class TestNode(unittest.TestCase):
         self.assertRoundtrip(raw_node, Node.Leaf)
 
 
+class TestHash(unittest.TestCase):
+    def test_keccak_hash(self):
+        self.assertEqual(keccak_hash(b''), bytes.fromhex('c5d2460186f7233c927e7db2dcc703c0e500b653ca82273b7bfad8045d85a470'))
+
+    def test_keccak_hash_many(self):
+        random.seed(42)
+        items = [bytes(random.randint(0, 255) for _ in range(length)) for length in range(300)]
+        items += [memoryview(b'view'), bytearray(b'array')]
+
+        self.assertEqual(keccak_hash_many(items), [keccak_hash(item) for item in items])
+        self.assertEqual(keccak_hash_many(iter(items[:3])), [keccak_hash(item) for item in items[:3]])
+        self.assertEqual(keccak_hash_many([]), [])
+
+    def test_secure_batch(self):
+        keys = [bytes('key_{}'.format(i), 'utf-8') for i in range(3000)]
+
+        trie = MerklePatriciaTrie({}, secure=True)
+        for kv in keys:
+            trie.update(kv, kv * 2)
+        for kv in keys[::3]:
+            trie.delete(kv)
+
+        batched_trie = MerklePatriciaTrie({}, secure=True)
+        batched_trie.apply_batch((kv, kv * 2) for kv in keys)
+        batched_trie.apply_batch((kv, None) for kv in keys[::3])
+
+        self.assertEqual(batched_trie.root_hash(), trie.root_hash())
+        self.assertEqual(batched_trie.get_many(keys[:3]), [None, keys[1] * 2, keys[2] * 2])
+
+
+class TestBackends(unittest.TestCase):
+    def setUp(self):
+        self.active = backends.active_backends()
+
+    def tearDown(self):
+        for kind, name in self.active.items():
+            backends.use_backend(kind, name)
+
+    def test_active_backends(self):
+        active = backends.active_backends()
+
+        self.assertEqual(set(active), {'keccak', 'rlp'})
+        self.assertEqual(active['rlp'], 'builtin')
+        self.assertIn(active['keccak'], backends.available_backends('keccak'))
+
+        with self.assertRaises(ValueError):
+            backends.use_backend('keccak', 'unknown')
+
+    def test_backends_give_same_results(self):
+        random.seed(42)
+        keys = [bytes('{}'.format(random.randint(1, 1000000)), 'utf-8') for _ in range(100)]
+        roots = set()
+
+        for keccak_backend in backends.available_backends('keccak'):
+            for rlp_backend in backends.available_backends('rlp'):
+                try:
+                    backends.use_backend('keccak', keccak_backend)
+                except ImportError:
+                    continue
+                backends.use_backend('rlp', rlp_backend)
+
+                self.assertEqual(backends.active_backends(), {'keccak': keccak_backend, 'rlp': rlp_backend})
+                self.assertEqual(keccak_hash_many([b'', b'abc']), [keccak_hash(b''), keccak_hash(b'abc')])
+
+                trie = MerklePatriciaTrie({})
+                for kv in keys:
+                    trie.update(kv, kv * 2)
+                roots.add(trie.root_hash())
+
+        self.assertEqual(len(roots), 1)
+
+    def test_builtin_codec(self):
+        inline_leaf = rlp.encode([b'\x35', b'x'])
+        hashed = keccak_hash(b'node')
+        nodes = [
+            [b'\x20\x12\x34', b'data'],
+            [b'\x31', b'\x01'],
+            [b'\x20' + b'\x12' * 32, b'v' * 100],
+            [b'\x00\x12', hashed],
+            [b'\x11', rlp.decode(inline_leaf)],
+            [b''] * 16 + [b''],
+            [hashed] * 15 + [rlp.decode(inline_leaf), b'value'],
+        ]
+
+        backends.use_backend('rlp', 'builtin')
+
+        for items in nodes:
+            raw_node = rlp.encode(items)
+            node = Node.decode(raw_node)
+
+            # Inline references are kept encoded.
+            if type(node) is Node.Branch:
+                self.assertEqual(node.branches[15], inline_leaf if node.branches[0] else b'')
+            elif type(node) is Node.Extension:
+                self.assertIn(node.next_ref, (hashed, inline_leaf))
+
+            node._encoded = None
+            self.assertEqual(node.encode(), raw_node)
+
+        invalid_nodes = (b'', b'\x82a', b'\xc2\x80', b'\xc3\x80\x80\x80', b'\xc1\x80\x80', b'\x80',
+                         b'\xc2\x80\x80', b'\xc3\xc1\x80\x80', b'\xc2\x45\x80')
+        for rlp_backend in ('builtin', 'rlp'):
+            backends.use_backend('rlp', rlp_backend)
+            for invalid in invalid_nodes:
+                with self.assertRaises(ValueError):
+                    Node.decode(invalid)
+
+
+class TestNodeCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = NodeCache(max_entries=2)
+        cache.put(b'a', 'node_a', 10)
+        cache.put(b'b', 'node_b', 10)
+
+        self.assertEqual(cache.get(b'a'), 'node_a')
+
+        cache.put(b'c', 'node_c', 10)
+
+        self.assertIsNone(cache.get(b'b'))
+        self.assertEqual(cache.get(b'a'), 'node_a')
+        self.assertEqual(cache.get(b'c'), 'node_c')
+        self.assertEqual(cache.hits, 3)
+        self.assertEqual(cache.misses, 1)
+
+        # Just added node isn't evicted, even if all the others were used.
+        cache = NodeCache(max_entries=1)
+        cache.put(b'a', 'node_a', 10)
+        cache.get(b'a')
+        cache.put(b'b', 'node_b', 10)
+        self.assertNotIn(b'a', cache)
+        self.assertIn(b'b', cache)
+
+    def test_lock_free_lookups(self):
+        cache = NodeCache(max_entries=2)
+        cache.put(b'a', 'node_a', 10)
+
+        # Lookups in other threads succeed while the cache is being changed.
+        results = []
+        with cache._lock:
+            reader = threading.Thread(target=lambda: results.append((cache.get(b'a'), cache.get(b'b'))))
+            reader.start()
+            reader.join(timeout=10)
+
+        self.assertEqual(results, [('node_a', None)])
+
+    def test_byte_budget(self):
+        cache = NodeCache(max_entries=None, max_bytes=100)
+        for i in range(10):
+            cache.put(bytes([i]), i, 30)
+
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.size(), 90)
+
+        cache.put(b'large', 'large', 101)
+        self.assertNotIn(b'large', cache)
+
+    def test_trie_with_cache(self):
+        random.seed(42)
+        keys = list(set(bytes('{}'.format(random.randint(1, 1000000)), 'utf-8') for _ in range(100)))
+
+        storage = {}
+        cache = NodeCache(max_entries=50)
+        trie = MerklePatriciaTrie(storage, cache=cache)
+        reference_trie = MerklePatriciaTrie({})
+
+        for kv in keys:
+            trie.update(kv, kv * 2)
+            reference_trie.update(kv, kv * 2)
+
+        old_root = trie.root()
+
+        for kv in keys[::2]:
+            trie.update(kv, kv * 3)
+            reference_trie.update(kv, kv * 3)
+        for kv in keys[1::4]:
+            trie.delete(kv)
+            reference_trie.delete(kv)
+
+        self.assertEqual(trie.root_hash(), reference_trie.root_hash())
+
+        # Cached nodes of the old root must not be affected by the updates.
+        old_trie = MerklePatriciaTrie(storage, old_root, cache=cache)
+        for kv in keys:
+            self.assertEqual(old_trie.get(kv), kv * 2)
+
+        self.assertGreater(cache.hits, 0)
+
+
+class BulkStorage(dict):
+    """ Dict storage with bulk reads and writes that counts storage accesses. """
+
+    def __init__(self):
+        super().__init__()
+        self.bulk_reads = 0
+        self.bulk_writes = 0
+        self.read_keys = []
+
+    def get_many(self, keys):
+        self.bulk_reads += 1
+        self.read_keys.extend(keys)
+        return [self.get(key) for key in keys]
+
+    def put_many(self, items):
+        self.bulk_writes += 1
+        self.update(items)
+
+
+class TestStorage(unittest.TestCase):
+    def check_storage(self, storage, key_length=1):
+        a, b, c, d = (letter * key_length for letter in (b'a', b'b', b'c', b'd'))
+
+        storage[a] = b'1'
+        storage.put_many([(b, b'2'), (c, b'3')])
+
+        self.assertEqual(storage[a], b'1')
+        self.assertIn(b, storage)
+        self.assertEqual(storage.get_many([c, d, a]), [b'3', None, b'1'])
+
+        storage.delete_many([a, d])
+        del storage[b]
+
+        self.assertNotIn(a, storage)
+        self.assertNotIn(b, storage)
+        with self.assertRaises(KeyError):
+            storage[a]
+
+    def test_dict_storage(self):
+        self.check_storage(DictStorage())
+
+    def test_dbm_storage(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with DbmStorage(os.path.join(directory, 'nodes')) as storage:
+                self.check_storage(storage)
+
+    def test_segment_storage(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with SegmentStorage(directory) as storage:
+                self.check_storage(storage, key_length=32)
+                self.assertIsInstance(storage[b'c' * 32], memoryview)
+
+                # Keys are stored in 32-byte fields, so other keys would be changed on disk.
+                for key in (b'a', b'x' * 40):
+                    with self.assertRaises(ValueError):
+                        storage[key] = b'value'
+
+            with SegmentStorage(directory) as storage:
+                self.assertEqual(len(storage), 1)
+                self.assertEqual(storage[b'c' * 32], b'3')
+                self.assertNotIn(b'a' * 32, storage)
+
+                # Changes are merged with the saved index.
+                storage.put_many([(b'a' * 32, b'4'), (b'd' * 32, b'5')])
+                del storage[b'c' * 32]
+
+            with SegmentStorage(directory) as storage:
+                self.assertEqual(len(storage), 2)
+                self.assertEqual(storage.get_many([b'a' * 32, b'c' * 32, b'd' * 32]), [b'4', None, b'5'])
+
+    def test_segment_storage_reopen(self):
+        random.seed(42)
+        keys = list(set(bytes('{}'.format(random.randint(1, 1000000)), 'utf-8') for _ in range(200)))
+
+        with tempfile.TemporaryDirectory() as directory:
+            # Small segments, so the nodes are spread over several of them.
+            storage = SegmentStorage(directory, segment_size=4096)
+            trie = MerklePatriciaTrie(storage)
+            trie.apply_batch((kv, kv * 2) for kv in keys)
+            root = trie.root()
+            storage.close()
+
+            storage = SegmentStorage(directory, segment_size=4096)
+            trie = MerklePatriciaTrie(storage, root)
+            for kv in keys:
+                self.assertEqual(trie.get(kv), kv * 2)
+
+            # Committed changes without saved index are replayed from the segments.
+            trie.update(b'committed', b'value')
+            storage.commit()
+            committed_root = trie.root()
+            committed_size = len(storage)
+
+            # Changes that aren't committed are lost after the crash.
+            trie.update(b'not_committed', b'value')
+            os.remove(os.path.join(directory, 'index.dat'))
+
+            recovered_storage = SegmentStorage(directory, segment_size=4096)
+            self.assertEqual(len(recovered_storage), committed_size)
+
+            recovered_trie = MerklePatriciaTrie(recovered_storage, committed_root)
+            self.assertEqual(recovered_trie.get(b'committed'), b'value')
+            self.assertEqual(recovered_trie.get(keys[0]), keys[0] * 2)
+
+            recovered_trie.update(b'after_recovery', b'value')
+            recovered_storage.close()
+
+            with SegmentStorage(directory, segment_size=4096) as storage:
+                trie = MerklePatriciaTrie(storage, recovered_trie.root())
+                self.assertEqual(trie.get(b'after_recovery'), b'value')
+                self.assertEqual(trie.get(b'committed'), b'value')
+
+    def test_sqlite_storage(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'nodes.db')
+
+            with SqliteStorage(path) as storage:
+                self.check_storage(storage)
+
+                keys = [i.to_bytes(32, 'big') for i in range(600)]
+                storage.put_many((key, key[:4]) for key in keys)
+                self.assertEqual(storage.get_many(keys + [b'missing']), [key[:4] for key in keys] + [None])
+
+                trie = MerklePatriciaTrie(storage)
+                trie.apply_batch((key, key) for key in keys)
+                root = trie.root()
+
+            with pickle.loads(pickle.dumps(SqliteStorage(path))) as storage:
+                trie = MerklePatriciaTrie(storage, root)
+                self.assertEqual(trie.get_many(keys[:10]), keys[:10])
+
+    def test_write_buffer(self):
+        self.check_storage(WriteBuffer(DictStorage()))
+
+        backend = BulkStorage()
+        backend[b'a'] = b'1'
+        storage = WriteBuffer(backend)
+
+        storage[b'b'] = b'2'
+        storage[b'b'] = b'3'
+        del storage[b'a']
+
+        self.assertEqual(storage.get_many([b'a', b'b']), [None, b'3'])
+        self.assertEqual(backend, {b'a': b'1'})
+        self.assertEqual(storage.pending(), 2)
+
+        storage.flush()
+
+        self.assertEqual(backend, {b'b': b'3'})
+        self.assertEqual(backend.bulk_writes, 1)
+        self.assertEqual(storage.pending(), 0)
+
+        storage[b'c'] = b'4'
+        storage.discard()
+        self.assertNotIn(b'c', storage)
+
+    def test_trie_bulk_writes(self):
+        keys = [bytes('key_{}'.format(i), 'utf-8') for i in range(100)]
+
+        storage = BulkStorage()
+        trie = MerklePatriciaTrie(storage)
+        trie.apply_batch((kv, kv * 2) for kv in keys)
+
+        self.assertEqual(storage.bulk_writes, 1)
+
+        sorted_storage = BulkStorage()
+        sorted_trie = MerklePatriciaTrie.from_sorted_items(sorted_storage, ((kv, kv * 2) for kv in sorted(keys)))
+
+        self.assertEqual(sorted_storage.bulk_writes, 1)
+        self.assertEqual(sorted_trie.root_hash(), trie.root_hash())
+
+        # Write buffer is flushed on every commit.
+        buffered_storage = WriteBuffer(BulkStorage())
+        buffered_trie = MerklePatriciaTrie(buffered_storage)
+        for kv in keys:
+            buffered_trie.update(kv, kv * 2)
+
+        self.assertEqual(buffered_storage.pending(), 0)
+        # At most one bulk write per update: the first root is inlined and isn't stored.
+        self.assertLessEqual(buffered_storage.backend().bulk_writes, len(keys))
+        self.assertEqual(buffered_trie.root_hash(), trie.root_hash())
+        self.assertEqual(MerklePatriciaTrie(buffered_storage.backend(), trie.root()).get(keys[0]), keys[0] * 2)
+
+        buffered_storage = WriteBuffer(BulkStorage())
+        buffered_trie = MerklePatriciaTrie(buffered_storage)
+        with buffered_trie.batch():
+            for kv in keys:
+                buffered_trie.update(kv, kv * 2)
+
+        self.assertEqual(buffered_storage.backend().bulk_writes, 1)
+
+        # Changes of the fork stay in its private buffer until merge, then the buffer of the parent is flushed.
+        fork = buffered_trie.fork()
+        fork.update(b'fork', b'value')
+        self.assertEqual(buffered_storage.backend().bulk_writes, 1)
+        fork.merge()
+        self.assertEqual(buffered_storage.backend().bulk_writes, 2)
+        self.assertEqual(buffered_storage.pending(), 0)
+        self.assertEqual(MerklePatriciaTrie(buffered_storage.backend(), fork.root()).get(b'fork'), b'value')
+
+
+def reachable_nodes(storage, root):
+    """ Returns hashes of all the stored nodes reachable from the root. """
+    result = set()
+    pending = [root] if root else []
+    while pending:
+        node_ref = pending.pop()
+        if len(node_ref) == 32:
+            result.add(node_ref)
+            node = Node.decode(storage[node_ref])
+        else:
+            node = Node.decode(node_ref)
+
+        if type(node) is Node.Extension:
+            pending.append(node.next_ref)
+        elif type(node) is Node.Branch:
+            pending.extend(branch for branch in node.branches if branch)
+
+    return result
+
+
+class TestPruning(unittest.TestCase):
+    def test_keep_one_root(self):
+        random.seed(42)
+        keys = list(set(bytes('{}'.format(random.randint(1, 1000000)), 'utf-8') for _ in range(100)))
+
+        storage = {}
+        trie = MerklePatriciaTrie(storage, pruner=RefCountPruner(storage, keep_roots=1))
+
+        for kv in keys:
+            trie.update(kv, kv * 20)
+            self.assertEqual(set(storage), reachable_nodes(storage, trie.root()))
+
+        for kv in keys[::2]:
+            trie.update(kv, kv * 30)
+            self.assertEqual(set(storage), reachable_nodes(storage, trie.root()))
+
+        for kv in keys:
+            trie.delete(kv)
+            self.assertEqual(set(storage), reachable_nodes(storage, trie.root()))
+
+        self.assertEqual(storage, {})
+
+    def test_keep_several_roots(self):
+        random.seed(42)
+        keys = list(set(bytes('{}'.format(random.randint(1, 1000000)), 'utf-8') for _ in range(100)))
+
+        storage = {}
+        pruner = RefCountPruner(storage, keep_roots=3)
+        trie = MerklePatriciaTrie(storage, pruner=pruner)
+
+        roots = []
+        for kv in keys:
+            trie.update(kv, kv * 20)
+            roots.append(trie.root())
+
+        for kv in keys[:50]:
+            with trie.batch():
+                trie.delete(kv)
+                trie.update(kv + b'_new', kv * 30)
+            roots.append(trie.root())
+
+        self.assertEqual(pruner.retained_roots(), roots[-3:])
+
+        expected_nodes = set()
+        for root in roots[-3:]:
+            expected_nodes |= reachable_nodes(storage, root)
+        self.assertEqual(set(storage), expected_nodes)
+
+        old_trie = MerklePatriciaTrie(storage, roots[-3])
+        self.assertEqual(old_trie.get(keys[47] + b'_new'), keys[47] * 30)
+        self.assertEqual(old_trie.get(keys[48]), keys[48] * 20)
+
+
+class TestDiff(unittest.TestCase):
+    def expected_diff(self, storage, root_a, root_b):
+        items_a = dict(MerklePatriciaTrie(storage, root_a).items())
+        items_b = dict(MerklePatriciaTrie(storage, root_b).items())
+
+        return [(key, items_a.get(key), items_b.get(key)) for key in sorted(items_a.keys() | items_b.keys())
+                if items_a.get(key) != items_b.get(key)]
+
+    def test_diff(self):
+        random.seed(42)
+        keys = list(set(bytes('{}'.format(random.randint(1, 1000000)), 'utf-8') for _ in range(300)))
+        # Keys that are prefixes of other keys put values into branches.
+        keys += [b'1', b'12', b'123']
+
+        storage = {}
+        trie = MerklePatriciaTrie(storage)
+        trie.apply_batch((key, key * 2) for key in keys[:200])
+        roots = [None, trie.root()]
+
+        trie.apply_batch((key, key * 3) for key in keys[::7])
+        roots.append(trie.root())
+
+        trie.apply_batch((key, None) for key in keys[:200:5] if key in keys[:200])
+        roots.append(trie.root())
+
+        trie.apply_batch((key, key) for key in keys[200:])
+        roots.append(trie.root())
+
+        for root_a in roots:
+            for root_b in roots:
+                self.assertEqual(list(diff(storage, root_a, root_b)), self.expected_diff(storage, root_a, root_b))
+
+    def test_diff_single_keys(self):
+        storage = {}
+        trie = MerklePatriciaTrie(storage)
+        trie.update(b'dog', b'puppy')
+        root_a = trie.root()
+        trie.update(b'doge', b'coin')
+        root_b = trie.root()
+        trie.delete(b'dog')
+        root_c = trie.root()
+
+        self.assertEqual(list(diff(storage, root_a, root_b)), [(b'doge', None, b'coin')])
+        self.assertEqual(list(diff(storage, root_a, root_c)), [(b'dog', b'puppy', None), (b'doge', None, b'coin')])
+        self.assertEqual(list(diff(storage, root_b, root_b)), [])
+
+    def test_diff_reads_only_changed_nodes(self):
+        keys = [os.urandom(32) for _ in range(5000)]
+
+        storage = {}
+        trie = MerklePatriciaTrie.from_sorted_items(storage, ((key, key) for key in sorted(keys)))
+        root_a = trie.root()
+        trie.update(keys[0], b'new')
+        root_b = trie.root()
+
+        read_keys = []
+        counting_storage = DictStorage(storage)
+        with mock.patch.object(DictStorage, '__getitem__', lambda self, key: read_keys.append(key) or storage[key]):
+            self.assertEqual(list(diff(counting_storage, root_a, root_b)), [(keys[0], keys[0], b'new')])
+
+        # Only nodes on the path of the changed key are read.
+        self.assertLess(len(read_keys), 20)
+
+
+class TestCompact(unittest.TestCase):
+    def build_history(self):
+        random.seed(42)
+        keys = list(set(bytes('{}'.format(random.randint(1, 1000000)), 'utf-8') for _ in range(200)))
+
+        storage = {}
+        trie = MerklePatriciaTrie(storage)
+        for kv in keys:
+            trie.update(kv, kv * 20)
+        old_root = trie.root()
+
+        for kv in keys[::3]:
+            trie.update(kv, kv * 30)
+
+        return storage, [old_root, trie.root(), b'']
+
+    def test_compact(self):
+        storage, roots = self.build_history()
+
+        reports = []
+        dest_storage = {}
+        copied = compact(storage, roots, dest_storage, progress=reports.append, progress_interval=100)
+
+        expected_nodes = reachable_nodes(storage, roots[0]) | reachable_nodes(storage, roots[1])
+        self.assertEqual(set(dest_storage), expected_nodes)
+        self.assertLess(len(dest_storage), len(storage))
+        self.assertEqual(copied, len(dest_storage))
+        self.assertEqual(reports[-1], copied)
+        self.assertGreater(len(reports), 1)
+
+        # Everything is copied already.
+        self.assertEqual(compact(storage, roots, dest_storage), 0)
+
+    def test_compact_parallel(self):
+        storage, roots = self.build_history()
+
+        dest_storage = {}
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            compact(storage, roots, dest_storage, executor=executor)
+
+        expected_nodes = reachable_nodes(storage, roots[0]) | reachable_nodes(storage, roots[1])
+        self.assertEqual(set(dest_storage), expected_nodes)
+
+    def test_compact_parallel_chunks(self):
+        storage, roots = self.build_history()
+        expected_nodes = reachable_nodes(storage, roots[0]) | reachable_nodes(storage, roots[1])
+
+        dest_storage = BulkStorage()
+        # Subtrees are returned in many small chunks, with few of them in flight.
+        with mock.patch('mpt.compact._CHUNK_SIZE', 7), mock.patch('mpt.compact._PARALLEL_TASKS', 2), \
+                ThreadPoolExecutor(max_workers=2) as executor:
+            compact(storage, roots, dest_storage, executor=executor)
+
+        self.assertEqual(set(dest_storage), expected_nodes)
+        self.assertGreater(dest_storage.bulk_writes, len(expected_nodes) // 7)
+
+    def test_compact_parallel_processes(self):
+        storage, roots = self.build_history()
+        expected_nodes = reachable_nodes(storage, roots[0]) | reachable_nodes(storage, roots[1])
+
+        with tempfile.TemporaryDirectory() as directory:
+            source_storage = SqliteStorage(os.path.join(directory, 'source.db'))
+            source_storage.put_many(storage.items())
+
+            reports = []
+            with SqliteStorage(os.path.join(directory, 'dest.db')) as dest_storage:
+                with ProcessPoolExecutor(max_workers=2) as executor:
+                    copied = compact(source_storage, roots, dest_storage, progress=reports.append,
+                                     progress_interval=100, executor=executor)
+
+            source_storage.close()
+
+            with SqliteStorage(os.path.join(directory, 'dest.db')) as dest_storage:
+                self.assertEqual(len(dest_storage), len(expected_nodes))
+                # Nodes shared by the old and the new tries are counted by several workers.
+                self.assertGreaterEqual(copied, len(expected_nodes))
+                self.assertEqual(reports[-1], copied)
+                self.assertLess(len(reports), copied // 100 + 2)
+
+                for root in roots[:2]:
+                    self.assertEqual(reachable_nodes(dest_storage, root), reachable_nodes(storage, root))
+
+    def test_compact_resume(self):
+        storage, roots = self.build_history()
+        expected_nodes = reachable_nodes(storage, roots[0]) | reachable_nodes(storage, roots[1])
+
+        def interrupt(copied):
+            raise KeyboardInterrupt
+
+        dest_storage = {}
+        with self.assertRaises(KeyboardInterrupt):
+            compact(storage, roots, dest_storage, progress=interrupt, progress_interval=5)
+        self.assertEqual(len(dest_storage), 5)
+
+        # Every copied node has its whole subtree copied.
+        for node_hash in dest_storage:
+            self.assertLessEqual(reachable_nodes(storage, node_hash), set(dest_storage))
+
+        copied = compact(storage, roots, dest_storage)
+        self.assertEqual(copied, len(expected_nodes) - 5)
+        self.assertEqual(set(dest_storage), expected_nodes)
+
+
 class TestMPT(unittest.TestCase):
     def test_insert_get_one_short(self):
         storage = {}
@@ -264,3 +1056,525 @@ class TestMPT(unittest.TestCase):
         self.assertEqual(trie.get(b'do'), b'not_a_verb')
         with self.assertRaises(KeyError):
             trie.get(b'dog')
+
+    def test_deep_trie(self):
+        # Each key is a prefix of the next one, so depth of the trie is about 1200 nodes.
+        keys = [b'k' * length for length in range(1, 600)]
+        value = b'v' * 40
+
+        trie = MerklePatriciaTrie.from_sorted_items({}, ((kv, value) for kv in keys))
+
+        self.assertEqual(trie.get(keys[-1]), value)
+        self.assertEqual(trie.get(keys[300]), value)
+
+        trie.update(keys[-1] + b'k', value)
+        trie.delete(keys[300])
+        with self.assertRaises(KeyError):
+            trie.get(keys[300])
+
+        with trie.batch():
+            trie.update(keys[300], value)
+            trie.delete(keys[-1] + b'k')
+
+        expected_trie = MerklePatriciaTrie.from_sorted_items({}, ((kv, value) for kv in keys))
+        self.assertEqual(trie.root_hash(), expected_trie.root_hash())
+
+    def test_batch_root_hash(self):
+        random.seed(42)
+        keys = [bytes('{}'.format(random.randint(1, 1000000)), 'utf-8') for _ in range(100)]
+
+        trie = MerklePatriciaTrie({})
+        for kv in keys:
+            trie.update(kv, kv * 2)
+        for kv in keys[::3]:
+            trie.delete(kv)
+
+        storage = {}
+        batched_trie = MerklePatriciaTrie(storage)
+        with batched_trie.batch():
+            for kv in keys:
+                batched_trie.update(kv, kv * 2)
+            for kv in keys[::3]:
+                batched_trie.delete(kv)
+
+        self.assertEqual(batched_trie.root_hash(), trie.root_hash())
+
+        trie_from_root = MerklePatriciaTrie(storage, batched_trie.root())
+        for kv in keys[1::3]:
+            self.assertEqual(trie_from_root.get(kv), kv * 2)
+
+    def test_batch_parallel(self):
+        random.seed(42)
+        keys = [bytes('{}'.format(random.randint(1, 1000000)), 'utf-8') for _ in range(1000)]
+
+        with ThreadPoolExecutor(max_workers=4) as thread_executor, \
+                ProcessPoolExecutor(max_workers=2) as process_executor:
+            for executor in (thread_executor, process_executor):
+                storage = {}
+                trie = MerklePatriciaTrie(storage)
+                trie.apply_batch((kv, kv * 2) for kv in keys)
+
+                parallel_storage = {}
+                parallel_trie = MerklePatriciaTrie(parallel_storage, cache=NodeCache())
+                parallel_trie.apply_batch(((kv, kv * 2) for kv in keys), executor=executor)
+
+                self.assertEqual(parallel_trie.root_hash(), trie.root_hash())
+                self.assertEqual(parallel_storage, storage)
+
+                # Changes of the existing trie are split into subtrees as well.
+                trie.apply_batch((kv, None) for kv in keys[::3])
+                parallel_trie.apply_batch(((kv, None) for kv in keys[::3]), executor=executor)
+
+                self.assertEqual(parallel_trie.root_hash(), trie.root_hash())
+                self.assertEqual(parallel_storage, storage)
+                self.assertEqual(parallel_trie.get(keys[1]), keys[1] * 2)
+
+    def test_batch_writes_less(self):
+        keys = [bytes('key_{}'.format(i), 'utf-8') for i in range(100)]
+
+        storage = {}
+        trie = MerklePatriciaTrie(storage)
+        for kv in keys:
+            trie.update(kv, kv * 2)
+
+        batched_storage = {}
+        batched_trie = MerklePatriciaTrie(batched_storage)
+        batched_trie.apply_batch((kv, kv * 2) for kv in keys)
+
+        self.assertEqual(batched_trie.root_hash(), trie.root_hash())
+        self.assertLess(len(batched_storage), len(storage))
+
+    def test_apply_batch_delete(self):
+        trie = MerklePatriciaTrie({})
+        trie.update(b'do', b'verb')
+        trie.update(b'dog', b'puppy')
+        trie.update(b'doge', b'coin')
+        trie.update(b'horse', b'stallion')
+        trie.update(b'dodo', b'pizza')
+
+        trie.apply_batch([(b'dodo', None), (b'hover', b'board'), (b'hover', None)])
+
+        self.assertEqual(trie.root_hash(), bytes.fromhex('5991bb8c6514148a29db676a14ac506cd2cd5775ace63c30a4fe457715e9ac84'))
+
+    def test_fork(self):
+        storage = {}
+        trie = MerklePatriciaTrie(storage)
+        trie.update(b'do', b'verb')
+        trie.update(b'dog', b'puppy')
+
+        root = trie.root()
+        stored_nodes = dict(storage)
+
+        fork = trie.fork()
+        fork.update(b'doge', b'coin')
+        fork.delete(b'do')
+
+        # Neither the trie nor the storage is affected.
+        self.assertEqual(trie.root(), root)
+        self.assertEqual(storage, stored_nodes)
+        self.assertEqual(fork.get(b'doge'), b'coin')
+        with self.assertRaises(KeyError):
+            fork.get(b'do')
+
+        fork.discard()
+        self.assertEqual(fork.root(), root)
+        self.assertEqual(fork.get(b'do'), b'verb')
+
+        fork.update(b'horse', b'stallion')
+        fork.update(b'doge', b'coin')
+        fork.merge()
+        self.assertEqual(trie.root(), fork.root())
+        self.assertEqual(MerklePatriciaTrie(storage, trie.root()).get(b'horse'), b'stallion')
+        # Intermediate nodes written by the fork are not merged.
+        self.assertEqual(set(storage), set(stored_nodes) | reachable_nodes(storage, trie.root()))
+
+        # Fork may be used after merge.
+        fork.update(b'dodo', b'pizza')
+        fork.merge()
+        self.assertEqual(trie.get(b'dodo'), b'pizza')
+
+    def test_nested_forks(self):
+        storage = {}
+        trie = MerklePatriciaTrie(storage, secure=True)
+        trie.update(b'do', b'verb')
+
+        forks = [trie.fork() for _ in range(10)]
+        for idx, fork in enumerate(forks):
+            fork.update(b'dog', bytes([idx]))
+
+        nested = forks[3].fork()
+        nested.update(b'doge', b'coin')
+        nested.merge()
+        self.assertEqual(forks[3].get(b'doge'), b'coin')
+        with self.assertRaises(KeyError):
+            trie.get(b'doge')
+
+        forks[3].merge()
+        self.assertEqual(trie.get(b'dog'), bytes([3]))
+        self.assertEqual(trie.get(b'doge'), b'coin')
+        self.assertEqual(forks[4].get(b'dog'), bytes([4]))
+
+        # Trie was changed after the other forks were made.
+        with self.assertRaises(ValueError):
+            forks[4].merge()
+        with self.assertRaises(ValueError):
+            trie.merge()
+
+    def test_fork_with_pruner(self):
+        storage = {}
+        trie = MerklePatriciaTrie(storage, pruner=RefCountPruner(storage, keep_roots=1))
+        trie.update(b'do', b'verb')
+        trie.update(b'dog', b'puppy')
+
+        fork = trie.fork()
+        fork.update(b'doge', b'coin')
+        fork.update(b'horse', b'stallion')
+        fork.merge()
+
+        self.assertEqual(set(storage), reachable_nodes(storage, trie.root()))
+
+        trie.delete(b'horse')
+        self.assertEqual(set(storage), reachable_nodes(storage, trie.root()))
+        self.assertEqual(trie.get(b'doge'), b'coin')
+
+    def test_checkpoints(self):
+        storage = {}
+        trie = MerklePatriciaTrie(storage)
+        trie.update(b'do', b'verb')
+
+        root = trie.root()
+        stored_nodes = dict(storage)
+
+        outer = trie.checkpoint()
+        trie.update(b'dog', b'puppy')
+        root_after_dog = trie.root()
+
+        inner = trie.checkpoint()
+        trie.update(b'doge', b'coin')
+        trie.delete(b'do')
+        self.assertEqual(trie.get(b'doge'), b'coin')
+
+        trie.revert(inner)
+        self.assertEqual(trie.root(), root_after_dog)
+        with self.assertRaises(KeyError):
+            trie.get(b'doge')
+        # Nothing reaches the storage while the checkpoint is open.
+        self.assertEqual(storage, stored_nodes)
+
+        with self.assertRaises(ValueError):
+            trie.revert(inner)
+
+        inner = trie.checkpoint()
+        trie.update(b'horse', b'stallion')
+        trie.commit(inner)
+        self.assertEqual(storage, stored_nodes)
+
+        trie.commit(outer)
+        self.assertEqual(trie.get(b'horse'), b'stallion')
+        self.assertEqual(trie.get(b'dog'), b'puppy')
+        # Only the nodes of the final root are written.
+        self.assertEqual(set(storage), set(stored_nodes) | reachable_nodes(storage, trie.root()))
+
+        checkpoint_id = trie.checkpoint()
+        trie.delete(b'horse')
+        trie.revert(checkpoint_id)
+        self.assertEqual(trie.get(b'horse'), b'stallion')
+        self.assertNotEqual(trie.root(), root)
+
+    def test_checkpoints_closed_together(self):
+        storage = {}
+        trie = MerklePatriciaTrie(storage, pruner=RefCountPruner(storage, keep_roots=1))
+        trie.update(b'do', b'verb')
+        root = trie.root()
+
+        outer = trie.checkpoint()
+        trie.update(b'dog', b'puppy')
+        trie.checkpoint()
+        trie.update(b'doge', b'coin')
+
+        # Reverting the outer checkpoint closes the inner one as well.
+        trie.revert(outer)
+        self.assertEqual(trie.root(), root)
+        self.assertEqual(set(storage), reachable_nodes(storage, root))
+
+        outer = trie.checkpoint()
+        trie.update(b'dog', b'puppy')
+        trie.checkpoint()
+        trie.update(b'doge', b'coin')
+        fork = trie.fork()
+        fork.update(b'horse', b'stallion')
+        fork.merge()
+        trie.commit(outer)
+
+        self.assertEqual(trie.get(b'horse'), b'stallion')
+        self.assertEqual(set(storage), reachable_nodes(storage, trie.root()))
+
+        trie.delete(b'doge')
+        self.assertEqual(set(storage), reachable_nodes(storage, trie.root()))
+
+    def test_concurrent_readers(self):
+        keys = [bytes('key_{}'.format(i), 'utf-8') for i in range(50)]
+
+        storage = {}
+        trie = MerklePatriciaTrie(storage, cache=NodeCache(max_entries=20))
+        trie.apply_batch((key, b'0') for key in keys)
+
+        blocks = 20
+        done = []
+
+        def write():
+            for block in range(1, blocks + 1):
+                value = bytes(str(block), 'utf-8')
+
+                # Reverted changes must never be visible.
+                checkpoint_id = trie.checkpoint()
+                trie.apply_batch((key, b'reverted') for key in keys)
+                trie.revert(checkpoint_id)
+
+                if block % 2:
+                    trie.apply_batch((key, value) for key in keys)
+                else:
+                    checkpoint_id = trie.checkpoint()
+                    for key in keys:
+                        trie.update(key, value)
+                    trie.commit(checkpoint_id)
+
+            done.append(True)
+
+        def read():
+            versions = []
+            while not done:
+                values = set(trie.reader().get_many(keys))
+                # Every reader sees all the keys of one block.
+                self.assertEqual(len(values), 1)
+                versions.append(int(values.pop()))
+
+            self.assertEqual(versions, sorted(versions))
+            return len(versions)
+
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            readers = [executor.submit(read) for _ in range(4)]
+            executor.submit(write).result()
+            reads = sum(reader.result() for reader in readers)
+
+        self.assertGreater(reads, 0)
+        self.assertEqual(set(trie.reader().get_many(keys)), {bytes(str(blocks), 'utf-8')})
+
+    def test_batch_discarded_on_error(self):
+        storage = {}
+        trie = MerklePatriciaTrie(storage)
+        trie.update(b'do', b'verb')
+
+        root = trie.root()
+        storage_size = len(storage)
+
+        with self.assertRaises(KeyError):
+            with trie.batch():
+                trie.update(b'dog', b'puppy')
+                trie.delete(b'horse')
+
+        self.assertEqual(trie.root(), root)
+        self.assertEqual(len(storage), storage_size)
+        with self.assertRaises(KeyError):
+            trie.get(b'dog')
+
+    def test_batch_discarded_on_write_error(self):
+        class FailingStorage(dict):
+            def put_many(self, items):
+                raise IOError("Disk is full")
+
+        storage = FailingStorage()
+        trie = MerklePatriciaTrie(storage)
+        trie.update(b'do', b'verb' * 10)
+        root = trie.root()
+
+        with self.assertRaises(IOError):
+            with trie.batch():
+                for kv in (b'dog', b'doge', b'horse'):
+                    trie.update(kv, kv * 10)
+
+        self.assertEqual(trie.root(), root)
+        self.assertEqual(trie.root_hash(), MerklePatriciaTrie(dict(storage), root).root_hash())
+        with self.assertRaises(KeyError):
+            trie.get(b'dog')
+
+        # Trie is still usable.
+        trie.update(b'dog', b'puppy')
+        self.assertEqual(trie.get(b'dog'), b'puppy')
+
+    def test_from_sorted_items(self):
+        random.seed(42)
+        keys = set(bytes('{}'.format(random.randint(1, 1000000)), 'utf-8') for _ in range(200))
+        keys.update([b'do', b'dog', b'doge', b'horse', b''])
+
+        for secure in (False, True):
+            trie = MerklePatriciaTrie({}, secure=secure)
+            for kv in keys:
+                trie.update(kv, kv * 2 + b'_value')
+
+            sort_key = keccak_hash if secure else None
+            items = ((kv, kv * 2 + b'_value') for kv in sorted(keys, key=sort_key))
+
+            storage = {}
+            built_trie = MerklePatriciaTrie.from_sorted_items(storage, items, secure=secure)
+
+            self.assertEqual(built_trie.root_hash(), trie.root_hash())
+            for kv in keys:
+                self.assertEqual(built_trie.get(kv), kv * 2 + b'_value')
+
+    def test_from_sorted_items_small(self):
+        trie = MerklePatriciaTrie.from_sorted_items({}, [])
+        self.assertEqual(trie.root_hash(), Node.EMPTY_HASH)
+
+        trie = MerklePatriciaTrie.from_sorted_items({}, [(b'key', b'value')])
+        self.assertEqual(trie.get(b'key'), b'value')
+
+        items = [(b'do', b'verb'), (b'dog', b'puppy'), (b'doge', b'coin'), (b'horse', b'stallion')]
+        trie = MerklePatriciaTrie.from_sorted_items({}, items)
+        self.assertEqual(trie.root_hash(), bytes.fromhex('5991bb8c6514148a29db676a14ac506cd2cd5775ace63c30a4fe457715e9ac84'))
+
+    def test_from_sorted_items_unsorted(self):
+        with self.assertRaises(ValueError):
+            MerklePatriciaTrie.from_sorted_items({}, [(b'dog', b'puppy'), (b'do', b'verb')])
+
+        with self.assertRaises(ValueError):
+            MerklePatriciaTrie.from_sorted_items({}, [(b'do', b'verb'), (b'do', b'verb')])
+
+    def test_get_many(self):
+        random.seed(42)
+        keys = list(set(bytes('{}'.format(random.randint(1, 1000000)), 'utf-8') for _ in range(200)))
+        missing_keys = [b'missing', b'', b'1', keys[0] + b'0']
+
+        for secure in (False, True):
+            storage = BulkStorage()
+            trie = MerklePatriciaTrie(storage, secure=secure)
+            for kv in keys:
+                trie.update(kv, kv * 2)
+
+            values = trie.get_many(keys + missing_keys)
+
+            self.assertEqual(values, [kv * 2 for kv in keys] + [None] * len(missing_keys))
+
+            # Every node is read once, one bulk read per level of the trie.
+            self.assertEqual(len(storage.read_keys), len(set(storage.read_keys)))
+            self.assertLess(storage.bulk_reads, 10)
+
+            storage.bulk_reads = 0
+            self.assertEqual(trie.get_many(keys[:10], bulk=False), [kv * 2 for kv in keys[:10]])
+            self.assertEqual(storage.bulk_reads, 0)
+
+    def test_get_many_small(self):
+        trie = MerklePatriciaTrie({})
+        self.assertEqual(trie.get_many([b'do']), [None])
+
+        trie.update(b'do', b'verb')
+        trie.update(b'dog', b'puppy')
+        trie.update(b'doge', b'coin')
+        trie.update(b'horse', b'stallion')
+
+        values = trie.get_many([b'doge', b'd', b'do', b'horse', b'do'])
+        self.assertEqual(values, [b'coin', None, b'verb', b'stallion', b'verb'])
+
+    def test_items(self):
+        random.seed(42)
+        keys = set(bytes('{}'.format(random.randint(1, 1000000)), 'utf-8') for _ in range(200))
+        keys.update([b'do', b'dog', b'doge', b'horse', b''])
+
+        trie = MerklePatriciaTrie({})
+        self.assertEqual(list(trie.items()), [])
+
+        for kv in keys:
+            trie.update(kv, kv + b'_value')
+
+        expected = [(kv, kv + b'_value') for kv in sorted(keys)]
+        self.assertEqual(list(trie.items()), expected)
+
+        self.assertEqual(list(trie.items(start=b'3', end=b'5')), [kv for kv in expected if b'3' <= kv[0] < b'5'])
+        self.assertEqual(list(trie.items(start=b'do', end=b'doge')), [(b'do', b'do_value'), (b'dog', b'dog_value')])
+
+        # Page through the trie by resuming from the last received key.
+        pages = []
+        start = None
+        while True:
+            page = []
+            for item in trie.items(start=start):
+                page.append(item)
+                if len(page) == 30:
+                    break
+            if not page:
+                break
+            pages.extend(page)
+            start = page[-1][0] + b'\x00'
+
+        self.assertEqual(pages, expected)
+
+        # Generator uses the root at the moment of the call, even if it's not started yet.
+        items = trie.items()
+        empty_items = MerklePatriciaTrie({}).items()
+        trie.update(b'new_key', b'new_value')
+        trie.delete(b'do')
+        self.assertEqual(list(items), expected)
+        self.assertEqual(list(empty_items), [])
+
+    def test_items_secure(self):
+        trie = MerklePatriciaTrie({}, secure=True)
+        trie.update(b'do', b'verb')
+        trie.update(b'dog', b'puppy')
+
+        expected = sorted([(keccak_hash(b'do'), b'verb'), (keccak_hash(b'dog'), b'puppy')])
+        self.assertEqual(list(trie.items()), expected)
+
+    def test_proof(self):
+        random.seed(42)
+        keys = list(set(bytes('{}'.format(random.randint(1, 1000000)), 'utf-8') for _ in range(200)))
+
+        for secure in (False, True):
+            trie = MerklePatriciaTrie({}, secure=secure)
+            for kv in keys:
+                trie.update(kv, kv * 2)
+
+            root_hash = trie.root_hash()
+
+            for kv in keys[:20]:
+                proof = trie.get_proof(kv)
+                self.assertEqual(verify_proof(root_hash, kv, proof, secure=secure), kv * 2)
+
+            for kv in [b'missing', b'1', keys[0] + b'0']:
+                proof = trie.get_proof(kv)
+                self.assertIsNone(verify_proof(root_hash, kv, proof, secure=secure))
+
+            # Proof of other key doesn't prove anything.
+            proof = trie.get_proof(keys[0])
+            with self.assertRaises(ValueError):
+                verify_proof(root_hash, keys[1], proof[:1], secure=secure)
+            with self.assertRaises(ValueError):
+                verify_proof(keccak_hash(b'other root'), keys[0], proof, secure=secure)
+
+    def test_proof_many(self):
+        random.seed(42)
+        keys = list(set(bytes('{}'.format(random.randint(1, 1000000)), 'utf-8') for _ in range(200)))
+
+        trie = MerklePatriciaTrie({})
+        for kv in keys:
+            trie.update(kv, kv * 2)
+
+        proof = trie.get_proof_many(keys[:50] + [b'missing'])
+
+        self.assertEqual(len(proof), len(set(proof)))
+        self.assertLess(len(proof), sum(len(trie.get_proof(kv)) for kv in keys[:50]))
+
+        for kv in keys[:50]:
+            self.assertEqual(verify_proof(trie.root_hash(), kv, proof), kv * 2)
+        self.assertIsNone(verify_proof(trie.root_hash(), b'missing', proof))
+
+    def test_proof_small(self):
+        trie = MerklePatriciaTrie({})
+        self.assertEqual(trie.get_proof(b'do'), [])
+        self.assertIsNone(verify_proof(trie.root_hash(), b'do', []))
+
+        # Root node is inlined.
+        trie.update(b'do', b'verb')
+        proof = trie.get_proof(b'do')
+        self.assertEqual(proof, [trie.root()])
+        self.assertEqual(verify_proof(trie.root_hash(), b'do', proof), b'verb')
+        self.assertIsNone(verify_proof(trie.root_hash(), b'dog', proof))